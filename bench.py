@@ -0,0 +1,345 @@
+"""Load and benchmark harness for server.py (standard library only).
+
+Starts server.py in a throwaway directory seeded with synthetic uploads,
+drives the hot paths (/api/login, /api/files, /api/upload) at several
+concurrency levels and prints latency percentiles, throughput and the
+server's peak RSS as JSON.
+
+    python bench.py --files 100,10000 --output before.json
+    python bench.py --files 100,10000 --compare before.json
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, 'server.py')
+PASSWORD = "2026"
+TAGS = ["Japanese", "English", "Math", "Science", "Social Studies"]
+SUBJECTS = ["数学", "国語", "英語", "理科", "社会", "math", "english", "physics"]
+BLOCK = os.urandom(1024 * 1024)
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for suffix, factor in (('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed(workdir, count):
+    """Create ``count`` small synthetic uploads plus a matching data.json."""
+    upload_dir = os.path.join(workdir, 'public', 'uploads')
+    os.makedirs(upload_dir)
+    # Static assets so / and /css/ can be served too
+    for name in ('css', 'js', 'image', 'index.html', 'login.html'):
+        src = os.path.join(HERE, 'public', name)
+        if os.path.exists(src):
+            os.symlink(src, os.path.join(workdir, 'public', name))
+
+    data = {}
+    payload = b'x' * 256
+    for i in range(count):
+        name = f"{SUBJECTS[i % len(SUBJECTS)]}_{2000 + i % 26}_{i:06d}.pdf"
+        with open(os.path.join(upload_dir, name), 'wb') as f:
+            f.write(payload)
+        data[name] = {"tags": [TAGS[i % len(TAGS)]]}
+    with open(os.path.join(workdir, 'data.json'), 'w') as f:
+        json.dump(data, f)
+
+
+class Server:
+    def __init__(self, workdir, port, extra_args):
+        self.workdir = workdir
+        self.port = port
+        cmd = [sys.executable, SERVER, '--port', str(port),
+               '--log-file', os.path.join(workdir, 'server.log'),
+               '--access-log', os.path.join(workdir, 'access.log')] + extra_args
+        self.proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with {self.proc.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def pids(self):
+        pids = [self.proc.pid]
+        try:
+            for task in os.listdir(f'/proc/{self.proc.pid}/task'):
+                with open(f'/proc/{self.proc.pid}/task/{task}/children') as f:
+                    pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+        return pids
+
+    def peak_rss_kb(self):
+        """Sum of VmHWM over the server and its worker processes (Linux only)."""
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total += int(line.split()[1])
+            except OSError:
+                return None
+        return total
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # Server closed a kept-alive connection; retry once on a new one
+            self.conn.close()
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.conn.close()
+        return response.status, response, data
+
+    def login(self):
+        status, response, _ = self.request('POST', '/api/login', json.dumps({"password": PASSWORD}),
+                                           {'Content-Type': 'application/json'})
+        if status == 200:
+            self.cookie = response.getheader('Set-Cookie').split(';')[0]
+        return status
+
+    def upload(self, size, tag='Math'):
+        boundary = uuid.uuid4().hex
+        name = f"bench_{uuid.uuid4().hex[:8]}.bin"
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="tags"\r\n\r\n{tag}\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+
+        def body():
+            yield head
+            # A unique prefix, or every upload after the first is a deduplicated hit
+            salt = uuid.uuid4().bytes[:size]
+            yield salt
+            remaining = size - len(salt)
+            while remaining:
+                chunk = BLOCK[:min(remaining, len(BLOCK))]
+                remaining -= len(chunk)
+                yield chunk
+            yield tail
+
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}',
+                   'Content-Length': str(len(head) + size + len(tail))}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.conn.close()
+        self.conn.request('POST', '/api/upload', body=body(), headers=headers, encode_chunked=False)
+        response = self.conn.getresponse()
+        data = response.read()
+        self.conn.close()
+        return response.status, response, data
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_load(port, concurrency, requests, action, login=True):
+    """Run ``requests`` calls of ``action(client)`` over ``concurrency`` threads."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        nonlocal errors
+        client = Client(port)
+        if login:
+            client.login()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = action(client)
+            except (http.client.HTTPException, OSError):
+                status = None
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status is None or status >= 400:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / wall, 2) if wall else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def bench_archive(args, count):
+    results = []
+    for c in args.concurrency:
+        # A freshly seeded server per level: uploads add rows that cannot be
+        # removed again, and would inflate the listings of the next level
+        workdir = tempfile.mkdtemp(prefix='kakomon-bench-')
+        try:
+            seed(workdir, count)
+            # One client address doing everything would trip the per-client rate
+            # limits, and the upload cap would turn the higher levels into 503s
+            limits = ['--login-rate', '0', '--upload-rate', '0', '--max-inflight-uploads', str(c)]
+            server = Server(workdir, free_port(), limits + args.server_args.split())
+            try:
+                def record(name, result, **extra):
+                    result.update(scenario=name, files=count, concurrency=c, **extra)
+                    result["peak_rss_kb"] = server.peak_rss_kb()
+                    results.append(result)
+                    print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+
+                # Warm the listing index once so the level measures the steady state
+                warm = Client(server.port)
+                warm.login()
+                warm.request('GET', '/api/files')
+
+                record('login', run_load(server.port, c, args.requests, lambda cl: cl.login(), login=False))
+                record('files_full', run_load(server.port, c, args.requests,
+                                              lambda cl: cl.request('GET', '/api/files')[0]))
+                record('files_search', run_load(
+                    server.port, c, args.requests,
+                    lambda cl: cl.request('GET', '/api/files?q=%E6%95%B0%E5%AD%A6&tag=Math&limit=50')[0]))
+                for size in args.upload_sizes:
+                    # Cap the bytes pushed per level so 500 MB runs stay bounded
+                    n = max(c, min(args.upload_requests, args.upload_budget // size))
+                    result = run_load(server.port, c, n, lambda cl: cl.upload(size)[0])
+                    result["mb_per_s"] = round(size * result["rps"] / (1 << 20), 2) if result["rps"] else None
+                    record('upload', result, size=size)
+            finally:
+                server.stop()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(baseline, current):
+    """Print p50/p95/rps changes against a previous run's results."""
+    def key(r):
+        return (r["scenario"], r["files"], r["concurrency"], r.get("size"))
+
+    old = {key(r): r for r in baseline["results"]}
+    for r in current["results"]:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        parts = []
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "rps", "peak_rss_kb"):
+            if b.get(metric) and r.get(metric) is not None:
+                parts.append(f"{metric} {b[metric]} -> {r[metric]} ({(r[metric] / b[metric] - 1) * 100:+.1f}%)")
+        label = "%s files=%s c=%s" % key(r)[:3] + (f" size={r['size']}" if r.get("size") else "")
+        print(f"{label}: " + ", ".join(parts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Kakomon portal server")
+    parser.add_argument('--files', type=int_list, default=[100, 10000],
+                        help="comma-separated archive sizes to seed, e.g. 100,10000,100000")
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per login/listing scenario and concurrency level")
+    parser.add_argument('--upload-sizes', type=lambda t: [parse_size(x) for x in t.split(',') if x],
+                        default=[10 << 10, 1 << 20, 50 << 20],
+                        help="comma-separated upload sizes, e.g. 10K,1M,50M,500M")
+    parser.add_argument('--upload-requests', type=int, default=20)
+    parser.add_argument('--upload-budget', type=parse_size, default=parse_size('2G'),
+                        help="bytes uploaded per size and concurrency level at most")
+    parser.add_argument('--server-args', default='',
+                        help="extra arguments for server.py, e.g. '--engine asyncio --workers 4'")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    report = {
+        "started": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "server_args": args.server_args,
+        "results": [],
+    }
+    for count in args.files:
+        report["results"].extend(bench_archive(args, count))
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,9 +19,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const sidebar = document.getElementById('sidebar');
     const sidebarOverlay = document.getElementById('sidebarOverlay');
 
-    let files = [];
     let currentFilterTag = 'all';
 
+    // Files larger than this are sent in resumable chunks (/api/uploads)
+    const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024;
+    const PARALLEL_CHUNKS = 4;
+    const CHUNK_RETRIES = 3;
+
     // --- State & i18n ---
     const translations = {
         en: {
@@ -107,60 +111,273 @@ document.addEventListener('DOMContentLoaded', () => {
         if (e.target === uploadModal) uploadModal.classList.remove('active');
     });
 
-    // --- File Fetching ---
-    async function fetchFiles() {
+    // --- File list ---
+    // The grid shows one search (query + tag) at a time, fetched page by page
+    // from /api/files. Only the rows on screen get cards; the rows above and
+    // below are stood in for by the grid's padding.
+    const PAGE_SIZE = 100;
+    const OVERSCAN_ROWS = 3;
+    const ESTIMATED_ROW_HEIGHT = 200;
+    const SEARCH_DEBOUNCE_MS = 200;
+
+    const gridStyle = getComputedStyle(fileGrid);
+    const basePadding = [parseFloat(gridStyle.paddingTop) || 0, parseFloat(gridStyle.paddingBottom) || 0];
+    const emptyMessage = document.createElement('p');
+    emptyMessage.style.cssText = 'text-align:center; grid-column:1/-1; color:#888;';
+
+    let view = null;         // the search on screen
+    let pendingView = null;  // replaces it once its first page arrives
+    let rowHeight = 0;
+    let renderQueued = false;
+    const cards = [];        // { el, icon, title, tags, date, file }, reused as the window moves
+    const lowerNames = new Map();
+
+    function newView() {
+        // pages: page number -> array of files, or null while it is loading
+        return { query: searchInput.value.trim(), tag: currentFilterTag, total: null, pages: new Map() };
+    }
+
+    function lowerName(name) {
+        let lower = lowerNames.get(name);
+        if (lower === undefined) {
+            lower = name.normalize('NFKC').toLowerCase();
+            lowerNames.set(name, lower);
+        }
+        return lower;
+    }
+
+    function layout(total) {
+        const columns = Math.max(1, getComputedStyle(fileGrid).gridTemplateColumns.split(' ').length);
+        const stride = (rowHeight || ESTIMATED_ROW_HEIGHT) + (parseFloat(gridStyle.rowGap) || 0);
+        const rows = Math.ceil(total / columns);
+        const scrolled = -(fileGrid.getBoundingClientRect().top + basePadding[0]);
+        const first = Math.max(0, Math.min(rows - 1, Math.floor(scrolled / stride) - OVERSCAN_ROWS));
+        const last = Math.max(0, Math.min(rows - 1, Math.ceil((scrolled + window.innerHeight) / stride) + OVERSCAN_ROWS));
+        return { columns, stride, rows, first, last };
+    }
+
+    function loadVisiblePages(v) {
+        const { columns, first, last } = layout(v.total === null ? Infinity : v.total);
+        const lastItem = (last + 1) * columns - 1;
+        for (let page = Math.floor(first * columns / PAGE_SIZE); page <= Math.floor(lastItem / PAGE_SIZE); page++) {
+            if (v.total !== null && page * PAGE_SIZE >= v.total) break;
+            if (!v.pages.has(page)) loadPage(v, page);
+        }
+    }
+
+    async function loadPage(v, page) {
+        v.pages.set(page, null);
+        const params = new URLSearchParams({ q: v.query, offset: page * PAGE_SIZE, limit: PAGE_SIZE });
+        if (v.tag !== 'all') params.append('tag', v.tag);
         try {
-            const response = await fetch('/api/files');
-            files = await response.json();
-            renderFiles();
+            const response = await fetch(`/api/files?${params}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const data = await response.json();
+            v.pages.set(page, data.files);
+            v.total = data.total;
+            if (catalogVersion === null) {
+                catalogVersion = response.headers.get('X-Catalog-Version');
+                subscribe();
+            }
         } catch (error) {
             console.error(error);
-            fileGrid.innerHTML = '<p style="text-align:center; grid-column:1/-1">Failed to load files</p>';
+            v.pages.delete(page);
+            if (!view) {
+                emptyMessage.textContent = 'Failed to load files';
+                fileGrid.replaceChildren(emptyMessage);
+            }
+            return;
+        }
+        if (v === pendingView) {
+            view = v;
+            pendingView = null;
         }
+        if (v === view) scheduleRender();
     }
 
-    function renderFiles() {
-        const query = searchInput.value.toLowerCase();
+    function setView(v) {
+        pendingView = v;
+        loadVisiblePages(v);
+    }
+
+    function search() {
+        // A new search starts from its first row
+        if (fileGrid.getBoundingClientRect().top < 0) fileGrid.scrollIntoView();
+        setView(newView());
+    }
+
+    function refresh() {
+        // Same search, current contents; the old rows stay up until they arrive
+        if (view) setView({ ...newView(), query: view.query, tag: view.tag });
+        else setView(newView());
+    }
 
-        const filtered = files.filter(file => {
-            const matchesSearch = file.name.toLowerCase().includes(query);
-            const matchesTag = currentFilterTag === 'all' || (file.tags && file.tags.includes(currentFilterTag));
-            return matchesSearch && matchesTag;
+    function scheduleRender() {
+        if (renderQueued) return;
+        renderQueued = true;
+        requestAnimationFrame(() => {
+            renderQueued = false;
+            renderFiles();
         });
+    }
 
-        fileGrid.innerHTML = '';
-        if (filtered.length === 0) {
-            fileGrid.innerHTML = '<p style="text-align:center; grid-column:1/-1; color:#888;">No matches found</p>';
+    function fillCard(card, file) {
+        if (card.file === file) return;
+        card.file = file;
+        card.el.classList.toggle('placeholder', !file);
+        card.el.dataset.name = file ? file.name : '';
+        if (!file) {
+            card.icon.textContent = '';
+            card.title.textContent = '';
+            card.tags.style.display = 'none';
+            card.date.textContent = '';
             return;
         }
+        let icon = '📄';
+        if (file.name.endsWith('.pdf')) icon = '📕';
+        if (file.name.match(/\.(jpg|png|jpeg)$/i)) icon = '🖼️';
+        card.icon.textContent = icon;
+        card.title.textContent = file.name;
+        card.tags.style.display = file.tags && file.tags.length ? '' : 'none';
+        card.tags.replaceChildren(...(file.tags || []).map(t => {
+            const pill = document.createElement('span');
+            pill.className = 'file-tag-pill';
+            pill.textContent = t;
+            return pill;
+        }));
+        card.date.textContent = file.date;
+    }
+
+    function makeCard() {
+        const el = document.createElement('div');
+        el.className = 'file-card';
+        el.innerHTML = `
+            <div class="file-icon"></div>
+            <div class="file-info">
+                <h3></h3>
+            </div>
+            <div class="file-tags"></div>
+            <div style="font-size:0.75rem; color:#999; margin-top:5px;"></div>
+        `;
+        const [icon, info, tags, date] = el.children;
+        return { el, icon, title: info.firstElementChild, tags, date, file: undefined };
+    }
+
+    function renderFiles() {
+        const v = view;
+        if (!v || v.total === null) return;
+        if (v.total === 0) {
+            fileGrid.style.paddingTop = fileGrid.style.paddingBottom = '';
+            emptyMessage.textContent = 'No matches found';
+            fileGrid.replaceChildren(emptyMessage);
+            return;
+        }
+
+        const { columns, stride, rows, first, last } = layout(v.total);
+        const start = first * columns;
+        const end = Math.min(v.total, (last + 1) * columns);
+        fileGrid.style.paddingTop = `${basePadding[0] + first * stride}px`;
+        fileGrid.style.paddingBottom = `${basePadding[1] + (rows - 1 - last) * stride}px`;
+
+        while (cards.length < end - start) cards.push(makeCard());
+        for (let i = start; i < end; i++) {
+            const page = v.pages.get(Math.floor(i / PAGE_SIZE));
+            fillCard(cards[i - start], page ? page[i % PAGE_SIZE] : null);
+        }
+        const shown = cards.slice(0, end - start).map(card => card.el);
+        if (fileGrid.children.length !== shown.length || shown.some((card, i) => fileGrid.children[i] !== card)) {
+            fileGrid.replaceChildren(...shown);
+        }
+        loadVisiblePages(v);
 
-        filtered.forEach(file => {
-            const card = document.createElement('div');
-            card.className = 'file-card';
+        // Rows must all be as tall as the tallest card for the padding maths to hold
+        const tallest = Math.max(...shown.map(card => card.offsetHeight));
+        if (tallest > rowHeight) {
+            rowHeight = tallest;
+            fileGrid.style.gridAutoRows = `${rowHeight}px`;
+            scheduleRender();
+        }
+    }
+
+    fileGrid.addEventListener('click', (e) => {
+        const card = e.target.closest('.file-card');
+        if (card && card.dataset.name) window.open(`/uploads/${encodeURIComponent(card.dataset.name)}`, '_blank');
+    });
+    window.addEventListener('scroll', scheduleRender, { passive: true });
+    window.addEventListener('resize', scheduleRender);
+
+    // --- Live updates ---
+    // /api/events pushes catalog changes, /api/files/changes catches up on
+    // demand. Changes to cards already loaded are patched in place; ones
+    // that add to or remove from the current search reload it.
+    let catalogVersion = null;
+    let events = null;
 
-            let icon = '📄';
-            if (file.name.endsWith('.pdf')) icon = '📕';
-            if (file.name.match(/\.(jpg|png|jpeg)$/i)) icon = '🖼️';
+    function matchesView(v, name, file) {
+        const terms = v.query.normalize('NFKC').toLowerCase().split(/\s+/).filter(Boolean);
+        if (!terms.every(t => lowerName(name).includes(t))) return false;
+        return !file || v.tag === 'all' || (file.tags || []).includes(v.tag);
+    }
 
-            // Generate tags HTML
-            const tagsHtml = file.tags && file.tags.length
-                ? `<div class="file-tags">${file.tags.map(t => `<span class="file-tag-pill">${t}</span>`).join('')}</div>`
-                : '';
+    function findLoaded(v, name) {
+        for (const files of v.pages.values()) {
+            const i = files ? files.findIndex(f => f.name === name) : -1;
+            if (i !== -1) return [files, i];
+        }
+        return null;
+    }
 
-            card.innerHTML = `
-                <div class="file-icon">${icon}</div>
-                <div class="file-info">
-                    <h3>${file.name}</h3>
-                </div>
-                ${tagsHtml}
-                <div style="font-size:0.75rem; color:#999; margin-top:5px;">${file.date}</div>
-            `;
+    // Returns true if the current search has to be reloaded
+    function applyChange(change) {
+        const v = view;
+        if (!v) return false;
+        const loaded = findLoaded(v, change.name);
+        if (change.op === 'add' || change.op === 'remove') {
+            return loaded !== null || matchesView(v, change.name, change.file);
+        }
+        if (!loaded) return v.tag !== 'all' && matchesView(v, change.name, change.file);
+        loaded[0][loaded[1]] = change.file;
+        return !matchesView(v, change.name, change.file);
+    }
 
-            card.onclick = () => window.open(`/uploads/${file.name}`, '_blank');
-            fileGrid.appendChild(card);
+    function subscribe() {
+        if (events || catalogVersion === null || !window.EventSource) return;
+        events = new EventSource(`/api/events?since=${catalogVersion}`);
+        let changed = false;
+        let stale = false;
+        ['add', 'remove', 'retag', 'update'].forEach(type => {
+            events.addEventListener(type, e => {
+                stale = applyChange(JSON.parse(e.data)) || stale;
+                changed = true;
+            });
+        });
+        // Each batch of changes ends with a version event
+        events.addEventListener('version', e => {
+            catalogVersion = e.lastEventId;
+            if (stale) refresh();
+            else if (changed) scheduleRender();
+            changed = stale = false;
+        });
+        events.addEventListener('reset', () => {
+            events.close();
+            events = null;
+            catalogVersion = null;
+            lowerNames.clear();
+            refresh();
         });
     }
 
+    async function syncChanges() {
+        if (catalogVersion === null) return refresh();
+        const response = await fetch(`/api/files/changes?since=${catalogVersion}`);
+        const delta = await response.json();
+        if (delta.reset) return refresh();
+        const stale = delta.changes.map(applyChange).some(Boolean);
+        catalogVersion = String(delta.version);
+        if (stale) refresh();
+        else scheduleRender();
+    }
+
     // --- Filtering ---
     tagButtons.forEach(btn => {
         btn.addEventListener('click', () => {
@@ -170,40 +387,55 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // Filter
             currentFilterTag = btn.dataset.filter;
-            renderFiles();
+            search();
         });
     });
 
-    searchInput.addEventListener('input', renderFiles);
+    let searchTimer = null;
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(search, SEARCH_DEBOUNCE_MS);
+    });
 
     // --- Upload ---
     uploadArea.addEventListener('click', () => fileInput.click());
     fileInput.addEventListener('change', () => {
-        if (fileInput.files.length) selectedFileName.textContent = fileInput.files[0].name;
+        if (fileInput.files.length === 1) selectedFileName.textContent = fileInput.files[0].name;
+        else if (fileInput.files.length) selectedFileName.textContent = `${fileInput.files.length} files`;
     });
 
     uploadForm.addEventListener('submit', async (e) => {
         e.preventDefault();
         if (!fileInput.files.length) return alert('Please select a file');
 
-        const formData = new FormData();
-        formData.append('file', fileInput.files[0]);
+        const selected = Array.from(fileInput.files);
 
         // Collect tags
         const selectedTags = Array.from(document.querySelectorAll('input[name="tags"]:checked'))
             .map(cb => cb.value);
-        if (selectedTags.length) formData.append('tags', selectedTags.join(','));
 
         try {
-            const res = await fetch('/api/upload', { method: 'POST', body: formData });
-            const result = await res.json();
+            // Large files go in resumable chunks, the rest in one batch request
+            const results = [];
+            for (const file of selected.filter(f => f.size > CHUNKED_UPLOAD_THRESHOLD)) {
+                results.push(await uploadChunked(file, selectedTags));
+            }
+            const small = selected.filter(f => f.size <= CHUNKED_UPLOAD_THRESHOLD);
+            if (small.length) {
+                const formData = new FormData();
+                small.forEach(file => formData.append('file', file));
+                if (selectedTags.length) formData.append('tags', selectedTags.join(','));
+                const res = await fetch('/api/upload', { method: 'POST', body: formData });
+                results.push(await res.json());
+            }
+            const result = { success: results.every(r => r.success) };
 
             if (result.success) {
                 alert('Uploaded!');
                 uploadModal.classList.remove('active');
                 uploadForm.reset();
                 selectedFileName.textContent = '';
-                fetchFiles();
+                syncChanges();
             } else {
                 alert('Failed');
             }
@@ -212,6 +444,89 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // --- Chunked upload ---
+    // The upload id is remembered per file so a retry after a dropped
+    // connection only sends the chunks the server doesn't have yet.
+    function uploadKey(file) {
+        return `kakomon-upload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function startOrResume(file, tags) {
+        const saved = localStorage.getItem(uploadKey(file));
+        if (saved) {
+            const res = await fetch(`/api/uploads/${saved}`);
+            if (res.ok) {
+                const info = await res.json();
+                return { id: saved, chunkSize: info.chunk_size || null, received: info.received };
+            }
+            localStorage.removeItem(uploadKey(file));
+        }
+        const res = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, tags })
+        });
+        if (!res.ok) throw new Error('Could not start upload');
+        const info = await res.json();
+        localStorage.setItem(uploadKey(file), info.id);
+        return { id: info.id, chunkSize: info.chunk_size, received: [] };
+    }
+
+    function missingChunks(size, chunkSize, received) {
+        const chunks = [];
+        for (let start = 0; start < size; start += chunkSize) {
+            const end = Math.min(start + chunkSize, size);
+            const done = received.some(([a, b]) => a <= start && end <= b);
+            if (!done) chunks.push([start, end]);
+        }
+        return chunks;
+    }
+
+    async function uploadChunked(file, tags) {
+        const session = await startOrResume(file, tags);
+        const chunkSize = session.chunkSize || 8 * 1024 * 1024;
+        const queue = missingChunks(file.size, chunkSize, session.received);
+        const total = queue.length;
+        let sent = 0;
+
+        async function sendChunk([start, end]) {
+            for (let attempt = 1; ; attempt++) {
+                let res = null;
+                try {
+                    res = await fetch(`/api/uploads/${session.id}?offset=${start}`, {
+                        method: 'PUT', body: file.slice(start, end)
+                    });
+                } catch (err) {
+                    // Network error: retry below
+                }
+                if (res && res.ok) return;
+                // 429/503 mean the server is shedding load: wait as told and retry
+                if (res && res.status < 500 && res.status !== 429) throw new Error(`Chunk rejected (${res.status})`);
+                if (attempt >= CHUNK_RETRIES) throw new Error('Chunk failed');
+                const wait = res && Number(res.headers.get('Retry-After'));
+                await new Promise(r => setTimeout(r, wait ? wait * 1000 : 1000 * attempt));
+            }
+        }
+
+        async function worker() {
+            while (queue.length) {
+                await sendChunk(queue.shift());
+                sent++;
+                selectedFileName.textContent = `${file.name} (${Math.round(sent / total * 100)}%)`;
+            }
+        }
+        await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+        const res = await fetch(`/api/uploads/${session.id}/finalize`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tags })
+        });
+        const result = await res.json();
+        if (result.success) localStorage.removeItem(uploadKey(file));
+        return result;
+    }
+
     // Init
-    fetchFiles();
+    setView(newView());
 });
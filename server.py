@@ -1,50 +1,3043 @@
 import http.server
+import http.client
 import http.cookies
 import socketserver
+import argparse
+import asyncio
+import queue
+import threading
+import itertools
+import functools
+import bisect
+import signal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import json
+import gzip
+import mimetypes
+import collections
+import sqlite3
+import contextlib
+import hashlib
 import os
 import shutil
+import tempfile
 import logging
+import logging.handlers
+import multiprocessing
+import random
+import re
+import struct
+import weakref
+import zlib
+import zipfile
+import selectors
+import socket
 import uuid
+import hmac
+import io
+import base64
+import secrets
+import time
+import unicodedata
+import urllib.parse
+import email.utils
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 from email.parser import BytesParser
 from email.policy import default
 
-# Configure logging
-logging.basicConfig(
-    filename=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_debug.log'),
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Logging
+LOG_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = os.path.join(LOG_DIR, 'server_debug.log')
+ACCESS_LOG_FILE = os.path.join(LOG_DIR, 'access.log')
+LOG_LEVEL = 'INFO'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+# Fraction of successful requests written to the access log; errors are always logged
+ACCESS_LOG_SAMPLE = 1.0
 
 PORT = 8090
+PUBLIC_DIR = 'public'
 UPLOAD_DIR = 'public/uploads'
 DATA_FILE = 'data.json'
 PASSWORD = "2026"
 SESSION_COOKIE_NAME = "kakomon_session"
-SESSIONS = set()
 
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
+# Sessions ('memory' or 'signed')
+SESSION_BACKEND = 'memory'
+SESSION_TTL = 12 * 3600
+MAX_SESSIONS = 10000
+# Signing key for 'signed' sessions; must not live anywhere the server serves
+SESSION_SECRET_FILE = (os.environ.get('KAKOMON_SESSION_KEY')
+                       or os.path.join(os.path.expanduser('~'), '.config', 'kakomon', 'session.key'))
+
+# Serving engine
+DEFAULT_ENGINE = 'threadpool'
+THREAD_WORKERS = 16
+QUEUE_SIZE = 64
+CONNECTION_TIMEOUT = 30
+
+# Persistent connections: idle time allowed between requests and requests per connection
+KEEPALIVE_TIMEOUT = 15
+MAX_KEEPALIVE_REQUESTS = 100
+# Unread request bodies up to this size are read and discarded so the
+# connection can be reused; larger ones get a lingering close instead
+MAX_DRAIN_BYTES = 1024 * 1024
+LINGER_TIMEOUT = 2
+
+# Admission control: bodies over the route's limit get 413 before they are read,
+# uploads beyond the in-flight cap get 503, and login/upload are rate limited
+# per session (or per IP before login) with token buckets. The IP is the peer's,
+# so behind a reverse proxy list it in TRUSTED_PROXIES (--trusted-proxy) to key
+# on X-Forwarded-For instead; otherwise every client shares the proxy's bucket
+MAX_UPLOAD_BYTES = 1024 * 1024 * 1024
+MAX_INFLIGHT_UPLOADS = 8
+UPLOAD_RETRY_AFTER = 5
+LOGIN_RATE = (10, 5)      # per minute, burst
+UPLOAD_RATE = (120, 20)
+MAX_RATE_KEYS = 10000
+TRUSTED_PROXIES = ()
+
+# Uploads are streamed in pieces of this size
+CHUNK_SIZE = 64 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+MAX_BATCH_FILES = 500
+
+# File serving
+STATIC_PREFIXES = ('/public/css/', '/public/js/', '/public/image/')
+STATIC_MAX_AGE = 7 * 24 * 3600
+# Pages whose asset links get a content hash, see AssetVersions
+PAGES = ('/public/index.html', '/public/login.html')
+MAX_RANGES = 16
+
+# Compression
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml')
+GZIP_MIN_SIZE = 1024
+GZIP_MAX_SIZE = 4 * 1024 * 1024
+GZIP_CACHE_SIZE = 32 * 1024 * 1024
+# Already compressed; /api/archive stores these instead of deflating them again
+ARCHIVE_STORED_TYPES = ('application/pdf', 'image/', 'video/', 'audio/', 'application/zip',
+                        'application/gzip', 'application/x-7z-compressed')
+
+# Metrics
+API_ROUTES = ('/api/files', '/api/files/changes', '/api/events', '/api/upload', '/api/uploads',
+              '/api/archive', '/api/login', '/api/metrics')
+# Bearer token that lets a scraper read /api/metrics without logging in;
+# unset, only a session can
+METRICS_TOKEN = os.environ.get('KAKOMON_METRICS_TOKEN', '')
+
+# /api/files paging
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Uploads are stored once per content, named by SHA-256, under
+# BLOB_DIR/ab/cd/<digest> so no directory grows past a few thousand entries
+BLOB_DIR = 'blobs'
+BLOB_SHARD_LEVELS = 2
+# Leftovers in UPLOAD_DIR that are not uploads
+LEGACY_SKIP_SUFFIXES = ('.py', '.log')
+
+# Where blob contents live ('local' or 's3'); S3 credentials are read from
+# AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+STORAGE_BACKEND = 'local'
+S3_ENDPOINT = 'http://127.0.0.1:9000'
+S3_BUCKET = 'kakomon'
+S3_REGION = 'us-east-1'
+S3_PREFIX = 'blobs/'
+S3_TIMEOUT = 60
+# Remote blobs are cached on local disk, and the small ones in memory too
+BLOB_CACHE_DIR = os.path.join(BLOB_DIR, '.cache')
+BLOB_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+MEMORY_CACHE_MAX_OBJECT = 2 * 1024 * 1024
+
+# Metadata backend ('sqlite' or 'json')
+METADATA_BACKEND = 'sqlite'
+DB_FILE = 'data.sqlite3'
+
+# Change feed: /api/files/changes and the /api/events stream
+CHANGE_LOG_SIZE = 10000
+MAX_EVENT_CLIENTS = 1000
+EVENT_POLL_INTERVAL = 1
+EVENT_KEEPALIVE = 25
+
+# Pre-fork mode
+WORKER_PROCESSES = 1
+SHUTDOWN_GRACE = 10
+# Workers still running this long after SIGTERM get SIGKILL
+WORKER_KILL_TIMEOUT = SHUTDOWN_GRACE + 5
+
+# Background jobs run after each upload ('thread' or 'process' workers)
+JOB_WORKERS = 2
+JOB_MODE = 'thread'
+JOB_LEASE = 300
+JOB_POLL_INTERVAL = 5
+JOB_RETRY_DELAY = 10
+MAX_JOB_ATTEMPTS = 5
+# Extracted text kept for full-text search, and how much of a PDF is parsed for it
+MAX_TEXT_CHARS = 200000
+MAX_EXTRACT_BYTES = 64 * 1024 * 1024
+
+# Resumable uploads: POST /api/uploads, PUT chunks at offsets, then finalize
+UPLOAD_SESSION_DIR = os.path.join(BLOB_DIR, '.sessions')
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_CHUNK = 64 * 1024 * 1024
+# Sessions with no chunk for this long are deleted
+UPLOAD_SESSION_TTL = 24 * 3600
+UPLOAD_SWEEP_INTERVAL = 600
+# Temp files of single-request uploads untouched this long were left by a crash
+STALE_UPLOAD_AGE = 3600
+
+for d in (UPLOAD_DIR, BLOB_DIR, UPLOAD_SESSION_DIR):
+    if not os.path.exists(d):
+        os.makedirs(d)
+
+
+class BlobStore:
+    """Interface for where blob contents live.
+
+    Blobs are immutable and named by the SHA-256 of their contents, so a
+    blob that exists is complete and never changes.
+    """
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def prepare(self, tmp_path, digest):
+        """Start storing ``tmp_path`` ahead of put(), before any metadata lock is taken."""
+
+    def put(self, tmp_path, digest):
+        """Store ``tmp_path`` as blob ``digest``, keeping the blob if it exists, and remove it."""
+        raise NotImplementedError
+
+    def delete(self, digest):
+        raise NotImplementedError
+
+    def open(self, digest):
+        """Return a binary file object for the blob; raise FileNotFoundError if there is none."""
+        raise NotImplementedError
+
+    def local_path(self, digest):
+        """Return the path of a local file with the blob's contents, or None if there is none."""
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files in a local directory, sharded as ab/cd/<digest>."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        shards = [digest[2 * i:2 * i + 2] for i in range(BLOB_SHARD_LEVELS)]
+        return os.path.join(self.root, *shards, digest)
+
+    def local_path(self, digest):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return path
+        # Blobs written before sharding stay flat until --migrate-uploads moves them
+        flat = os.path.join(self.root, digest)
+        return flat if os.path.exists(flat) else None
+
+    def exists(self, digest):
+        return self.local_path(digest) is not None
+
+    def put(self, tmp_path, digest):
+        if self.exists(digest):
+            os.remove(tmp_path)
+            return
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    def delete(self, digest):
+        path = self.local_path(digest)
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def open(self, digest):
+        path = self.local_path(digest)
+        if path is None:
+            raise FileNotFoundError(digest)
+        return open(path, 'rb')
+
+    def digests(self):
+        """Every blob's digest, sharded or not."""
+        found = []
+
+        def walk(path, depth):
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth < BLOB_SHARD_LEVELS:
+                            walk(entry.path, depth + 1)
+                    elif len(entry.name) == 64:
+                        found.append(entry.name)
+        walk(self.root, 0)
+        return found
+
+    def reshard(self):
+        """Move flat blobs into their shard directories; returns how many moved."""
+        moved = 0
+        with os.scandir(self.root) as it:
+            flat = [entry.name for entry in it
+                    if len(entry.name) == 64 and entry.is_file(follow_symlinks=False)]
+        for digest in flat:
+            src, dest = os.path.join(self.root, digest), self.path(digest)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                # Link first so readers that already resolved the flat path still find it
+                os.link(src, dest)
+            except FileExistsError:
+                pass
+            except FileNotFoundError:
+                continue
+            os.remove(src)
+            moved += 1
+        return moved
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects named <prefix><digest> in an S3-compatible bucket (AWS S3, MinIO...).
+
+    Requests use path-style URLs and AWS Signature Version 4. The digest
+    is the SHA-256 of the object, so it doubles as the signed payload hash
+    and the server checks every upload for us.
+    """
+
+    EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', prefix=''):
+        url = urllib.parse.urlsplit(endpoint)
+        self.https = url.scheme == 'https'
+        self.host = url.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.local = threading.local()
+
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, timeout=S3_TIMEOUT)
+
+    def sign(self, method, path, headers, payload_hash, now=None):
+        """Add the date, payload hash and SigV4 Authorization headers to ``headers``."""
+        amz_date = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+        headers.update({'Host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+        canonical_headers = sorted((k.lower(), str(v).strip()) for k, v in headers.items())
+        signed_headers = ';'.join(k for k, _ in canonical_headers)
+        canonical_request = '\n'.join([
+            method, urllib.parse.quote(path), '',
+            ''.join(f'{k}:{v}\n' for k, v in canonical_headers),
+            signed_headers, payload_hash])
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed_headers}, Signature={signature}')
+        return headers
+
+    def request(self, method, digest, body=None, length=None, payload_hash=EMPTY_SHA256, stream=False):
+        """Send one request for ``digest``; returns the response, with the body read unless ``stream``."""
+        path = f'/{self.bucket}/{self.prefix}{digest}'
+        for attempt in (1, 2):
+            # One kept-alive connection per thread (and process: none survive fork());
+            # streamed responses get their own, closed along with the response
+            conn = getattr(self.local, 'conn', None)
+            if stream or conn is None or self.local.pid != os.getpid():
+                conn = self.connect()
+                if not stream:
+                    self.local.conn, self.local.pid = conn, os.getpid()
+            headers = self.sign(method, path, {}, payload_hash)
+            if body is not None:
+                headers['Content-Length'] = str(length)
+                body.seek(0)
+            try:
+                conn.request(method, urllib.parse.quote(path), body=body, headers=headers)
+                response = conn.getresponse()
+                if not stream:
+                    response.read()
+                return response
+            except (http.client.HTTPException, ConnectionError):
+                # Most likely a kept-alive connection the server has since closed
+                conn.close()
+                self.local.conn = None
+                if stream or attempt == 2:
+                    raise
+
+    def check(self, response, method, digest):
+        if response.status >= 300:
+            raise OSError(f"S3 {method} {digest} failed: {response.status} {response.reason}")
+
+    def exists(self, digest):
+        response = self.request('HEAD', digest)
+        if response.status == 404:
+            return False
+        self.check(response, 'HEAD', digest)
+        return True
+
+    def prepare(self, tmp_path, digest):
+        if self.exists(digest):
+            return
+        with open(tmp_path, 'rb') as f:
+            response = self.request('PUT', digest, f, os.fstat(f.fileno()).st_size, payload_hash=digest)
+        self.check(response, 'PUT', digest)
+
+    def put(self, tmp_path, digest):
+        # Usually just a HEAD: prepare() has uploaded it already, unless the
+        # last reference to an identical blob was deleted in the meantime
+        self.prepare(tmp_path, digest)
+        os.remove(tmp_path)
+
+    def delete(self, digest):
+        response = self.request('DELETE', digest)
+        if response.status != 404:
+            self.check(response, 'DELETE', digest)
+
+    def open(self, digest):
+        response = self.request('GET', digest, stream=True)
+        if response.status == 404:
+            response.close()
+            raise FileNotFoundError(digest)
+        self.check(response, 'GET', digest)
+        return response
+
+    def local_path(self, digest):
+        # Only ever used behind a BlobCache
+        return None
+
+
+class MemoryBlob(io.BytesIO):
+    """A cached blob served from memory; ``st`` is the stat of the file it was read from."""
+
+    def __init__(self, data, st):
+        super().__init__(data)
+        self.st = st
+
+
+class BlobCache(BlobStore):
+    """Read-through LRU cache in front of a remote BlobStore.
+
+    Blobs are fetched whole into ``root`` on first use and evicted least
+    recently used first past ``disk_limit`` bytes; blobs up to
+    MEMORY_CACHE_MAX_OBJECT are also kept in memory, up to
+    ``memory_limit`` bytes. Worker processes share the directory but each
+    keeps its own LRU order, so the limit holds per process.
+    """
+
+    def __init__(self, backend, root, disk_limit, memory_limit):
+        self.backend = backend
+        self.root = root
+        self.disk_limit = disk_limit
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        self.disk = collections.OrderedDict()    # digest -> size
+        self.disk_total = 0
+        self.memory = collections.OrderedDict()  # digest -> (data, stat)
+        self.memory_total = 0
+        self.fetching = {}                       # digest -> [lock, waiters]
+        os.makedirs(root, exist_ok=True)
+
+        cached = []
+        stale = time.time() - 3600
+        with os.scandir(root) as it:
+            for entry in it:
+                st = entry.stat()
+                if not entry.name.startswith('.'):
+                    cached.append((st.st_atime, entry.name, st.st_size))
+                elif st.st_mtime < stale:
+                    # A fetch that never finished
+                    os.remove(entry.path)
+        for _, digest, size in sorted(cached):
+            self.disk[digest] = size
+            self.disk_total += size
+        self._evict()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def exists(self, digest):
+        return self.backend.exists(digest)
+
+    def prepare(self, tmp_path, digest):
+        self.backend.prepare(tmp_path, digest)
+
+    def put(self, tmp_path, digest):
+        # A new upload is likely to be read soon: keep it as cached too
+        fd, cached = tempfile.mkstemp(dir=self.root, prefix='.put-')
+        os.close(fd)
+        os.remove(cached)
+        try:
+            os.link(tmp_path, cached)
+        except OSError:
+            cached = None
+        try:
+            self.backend.put(tmp_path, digest)
+        except BaseException:
+            if cached:
+                os.remove(cached)
+            raise
+        if cached:
+            self._insert(cached, digest)
+
+    def delete(self, digest):
+        self.backend.delete(digest)
+        with self.lock:
+            self.disk_total -= self.disk.pop(digest, 0)
+            data, _ = self.memory.pop(digest, (b'', None))
+            self.memory_total -= len(data)
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def open(self, digest):
+        with self.lock:
+            entry = self.memory.get(digest)
+            if entry is not None:
+                self.memory.move_to_end(digest)
+        if entry is not None:
+            BLOB_CACHE.inc(result='memory')
+            return MemoryBlob(*entry)
+        for attempt in (1, 2):
+            path = self.local_path(digest)
+            if path is None:
+                raise FileNotFoundError(digest)
+            try:
+                f = open(path, 'rb')
+                break
+            except FileNotFoundError:
+                # Evicted by another worker just now; fetch it again
+                if attempt == 2:
+                    raise
+        st = os.fstat(f.fileno())
+        if st.st_size > MEMORY_CACHE_MAX_OBJECT or st.st_size > self.memory_limit:
+            return f
+        with f:
+            data = f.read()
+        with self.lock:
+            if digest not in self.memory:
+                self.memory[digest] = (data, st)
+                self.memory_total += len(data)
+            while self.memory_total > self.memory_limit:
+                _, (evicted, _) = self.memory.popitem(last=False)
+                self.memory_total -= len(evicted)
+        return MemoryBlob(data, st)
+
+    def local_path(self, digest):
+        path = self._path(digest)
+        with self.lock:
+            hit = digest in self.disk
+            if hit:
+                self.disk.move_to_end(digest)
+        if hit and os.path.exists(path):
+            BLOB_CACHE.inc(result='disk')
+            return path
+
+        with self._fetching(digest):
+            if os.path.exists(path):
+                # Fetched meanwhile by another thread or worker
+                self._insert(path, digest)
+                BLOB_CACHE.inc(result='disk')
+                return path
+            BLOB_CACHE.inc(result='miss')
+            try:
+                src = self.backend.open(digest)
+            except FileNotFoundError:
+                return None
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.fetch-')
+            try:
+                sha = hashlib.sha256()
+                with src, os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE * 16), b''):
+                        sha.update(chunk)
+                        f.write(chunk)
+                if sha.hexdigest() != digest:
+                    raise OSError(f"Blob {digest} is corrupt in storage")
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self._insert(tmp_path, digest)
+        return path
+
+    @contextlib.contextmanager
+    def _fetching(self, digest):
+        # One fetch per blob at a time; the others wait for it
+        with self.lock:
+            entry = self.fetching.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.fetching[digest]
+
+    def _insert(self, tmp_path, digest):
+        path = self._path(digest)
+        if tmp_path != path:
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.disk_total += size - self.disk.pop(digest, 0)
+            self.disk[digest] = size
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.disk_total <= self.disk_limit or len(self.disk) <= 1:
+                    return
+                digest, size = self.disk.popitem(last=False)
+                self.disk_total -= size
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+
+def open_blob_store(backend, s3_endpoint=S3_ENDPOINT, s3_bucket=S3_BUCKET, s3_region=S3_REGION,
+                    s3_prefix=S3_PREFIX, cache_bytes=BLOB_CACHE_BYTES, memory_cache_bytes=MEMORY_CACHE_BYTES):
+    if backend == 's3':
+        store = S3BlobStore(s3_endpoint, s3_bucket, os.environ.get('AWS_ACCESS_KEY_ID', ''),
+                            os.environ.get('AWS_SECRET_ACCESS_KEY', ''), s3_region, s3_prefix)
+        return BlobCache(store, BLOB_CACHE_DIR, cache_bytes, memory_cache_bytes)
+    return LocalBlobStore(BLOB_DIR)
+
+
+BLOBS = LocalBlobStore(BLOB_DIR)
+
+
+def upload_name_candidates(filename):
+    """The requested name first, then timestamped and numbered variants."""
+    name, ext = os.path.splitext(filename)
+    stamp = int(datetime.now().timestamp())
+    return itertools.chain(
+        [filename, f"{name}_{stamp}{ext}"],
+        (f"{name}_{stamp}_{n}{ext}" for n in itertools.count(1)))
+
+
+def legacy_file_exists(name):
+    # Uploads from before content addressing still live directly in UPLOAD_DIR
+    return os.path.exists(os.path.join(UPLOAD_DIR, name))
+
+
+def is_legacy_upload(entry):
+    """Whether a DirEntry in UPLOAD_DIR is an upload rather than a stray file."""
+    name = entry.name
+    return (not name.startswith('.') and not name.endswith(LEGACY_SKIP_SUFFIXES)
+            and name != 'data.json' and entry.is_file())
+
+
+class MetadataStore:
+    """Interface for file metadata backends.
+
+    Files stored by content have a ``digest`` naming their blob in BLOBS;
+    several names may share one blob, which is reference counted and
+    removed with its last name. Older files kept directly in UPLOAD_DIR
+    have no digest.
+    """
+
+    def all(self):
+        """Return {name: {"tags", "digest", "size", "added"}} for every known file."""
+        raise NotImplementedError
+
+    def lookup(self, name):
+        """Return the blob digest stored under ``name``, or None."""
+        raise NotImplementedError
+
+    def blob_info(self, name):
+        """Return (digest, added) for the blob stored under ``name``, or None."""
+        raise NotImplementedError
+
+    def put(self, name, tags):
+        """Set the tags of ``name``, creating a legacy entry if needed."""
+        raise NotImplementedError
+
+    def add_file(self, filename, tags, digest, size, tmp_path):
+        """Store ``tmp_path`` as blob ``digest`` under a free name derived from ``filename``.
+
+        Claiming the name and taking the blob reference happen atomically,
+        so concurrent uploads never share or overwrite a name. Returns
+        (name, deduplicated).
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def adopt_file(self, name, digest, size, added, tmp_path):
+        """Move legacy upload ``name`` into the blob store as ``tmp_path``.
+
+        Keeps its name, tags and date. Returns False, leaving ``tmp_path``
+        alone, if the name is gone or already content addressed.
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """Return a value that changes whenever the metadata changes."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # Post-upload jobs: one per blob, leased to a worker while it runs
+
+    def enqueue_job(self, digest):
+        """Queue derived-data extraction for ``digest`` unless it is done or queued."""
+        raise NotImplementedError
+
+    def claim_job(self, lease):
+        """Lease the next due job for ``lease`` seconds; return (id, digest, attempts) or None."""
+        raise NotImplementedError
+
+    def complete_job(self, job_id, digest, derived, text):
+        """Store the job's results with the blob and drop the job."""
+        raise NotImplementedError
+
+    def fail_job(self, job_id, error, retry_at):
+        """Record a failure; the job runs again at ``retry_at`` or never if it is None."""
+        raise NotImplementedError
+
+    def search_text(self, terms):
+        """Return digests whose extracted text contains every normalized term."""
+        raise NotImplementedError
+
+    def changes(self, since):
+        """Return (version, [(op, name), ...]) for changes after version ``since``.
+
+        The list is None when the changes can't be listed and the client has
+        to reload everything instead.
+        """
+        return self.version(), None
+
+
+class JsonMetadataStore(MetadataStore):
+    """Legacy backend keeping everything in one JSON file, rewritten on each change."""
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs_path = path + '.jobs'
+        # Extracted text by digest; kept apart so the main document stays small
+        self.text_path = path + '.text'
+        self.thread_lock = threading.Lock()
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump({}, f)
+        with self.lock():
+            data = self._load()
+            if any("text" in m for m in data.values()):
+                texts = self._load(self.text_path)
+                for meta in data.values():
+                    text = meta.pop("text", None)
+                    if text and meta.get("digest"):
+                        texts[meta["digest"]] = text
+                self._save(texts, self.text_path)
+                self._save(data)
+
+    def _load(self, path=None):
+        try:
+            with open(path or self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, data, path=None):
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @contextlib.contextmanager
+    def lock(self):
+        # flock on a sidecar file serialises writers in other worker processes too
+        with self.thread_lock, open(self.path + '.lock', 'a') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def all(self):
+        with self.lock():
+            data = self._load()
+        return {name: {"tags": meta.get("tags", []), "digest": meta.get("digest"),
+                       "size": meta.get("size"), "added": meta.get("added"),
+                       "derived": meta.get("derived")}
+                for name, meta in data.items()}
+
+    def lookup(self, name):
+        return self.all().get(name, {}).get("digest")
+
+    def blob_info(self, name):
+        meta = self.all().get(name, {})
+        return (meta["digest"], meta["added"]) if meta.get("digest") else None
+
+    def put(self, name, tags):
+        with self.lock():
+            data = self._load()
+            data.setdefault(name, {})["tags"] = tags
+            self._save(data)
+
+    @staticmethod
+    def _derived_for(data, digest):
+        # Derived data belongs to the blob; a new name for it inherits what is known
+        for meta in data.values():
+            if meta.get("digest") == digest and "derived" in meta:
+                return {"derived": meta["derived"]}
+        return {}
+
+    def add_file(self, filename, tags, digest, size, tmp_path):
+        BLOBS.prepare(tmp_path, digest)
+        with self.lock():
+            data = self._load()
+            name = next(n for n in upload_name_candidates(filename)
+                        if n not in data and not legacy_file_exists(n))
+            duplicate = any(m.get("digest") == digest for m in data.values())
+            BLOBS.put(tmp_path, digest)
+            data[name] = {"tags": tags, "digest": digest, "size": size,
+                          "added": datetime.now().timestamp(), **self._derived_for(data, digest)}
+            self._save(data)
+        return name, duplicate
+
+    def delete(self, name):
+        with self.lock():
+            data = self._load()
+            meta = data.pop(name, None)
+            if meta is None:
+                return
+            self._save(data)
+            digest = meta.get("digest")
+            if digest and not any(m.get("digest") == digest for m in data.values()):
+                BLOBS.delete(digest)
+                texts = self._load(self.text_path)
+                if texts.pop(digest, None) is not None:
+                    self._save(texts, self.text_path)
+
+    def adopt_file(self, name, digest, size, added, tmp_path):
+        BLOBS.prepare(tmp_path, digest)
+        with self.lock():
+            data = self._load()
+            meta = data.get(name, {})
+            if meta.get("digest") or not legacy_file_exists(name):
+                return False
+            BLOBS.put(tmp_path, digest)
+            data[name] = {"tags": meta.get("tags", []), "digest": digest, "size": size, "added": added,
+                          **self._derived_for(data, digest)}
+            self._save(data)
+        return True
+
+    def version(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def enqueue_job(self, digest):
+        with self.lock():
+            if any(m.get("digest") == digest and "derived" in m for m in self._load().values()):
+                return
+            jobs = self._load(self.jobs_path)
+            jobs.setdefault(digest, {"state": "pending", "attempts": 0, "run_after": 0})
+            self._save(jobs, self.jobs_path)
+
+    def claim_job(self, lease):
+        now = time.time()
+        with self.lock():
+            jobs = self._load(self.jobs_path)
+            for digest, job in sorted(jobs.items(), key=lambda item: item[1]["run_after"]):
+                if job["state"] != "failed" and job["run_after"] <= now:
+                    job.update(state="running", run_after=now + lease, attempts=job["attempts"] + 1)
+                    self._save(jobs, self.jobs_path)
+                    return digest, digest, job["attempts"]
+        return None
+
+    def complete_job(self, job_id, digest, derived, text):
+        with self.lock():
+            data = self._load()
+            for meta in data.values():
+                if meta.get("digest") == digest:
+                    meta["derived"] = derived
+            self._save(data)
+            if text:
+                texts = self._load(self.text_path)
+                texts[digest] = text
+                self._save(texts, self.text_path)
+            jobs = self._load(self.jobs_path)
+            jobs.pop(job_id, None)
+            self._save(jobs, self.jobs_path)
+
+    def fail_job(self, job_id, error, retry_at):
+        with self.lock():
+            jobs = self._load(self.jobs_path)
+            if job_id in jobs:
+                jobs[job_id].update(state="failed" if retry_at is None else "pending",
+                                    run_after=retry_at or 0, error=error)
+                self._save(jobs, self.jobs_path)
+
+    def search_text(self, terms):
+        with self.lock():
+            texts = self._load(self.text_path)
+        return {digest for digest, text in texts.items() if all(t in text for t in terms)}
+
+
+class SqliteMetadataStore(MetadataStore):
+    """SQLite backend in WAL mode; every change is a small single-row transaction."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            added REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            tag TEXT NOT NULL,
+            pos INTEGER NOT NULL,
+            PRIMARY KEY (file_id, tag)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag, file_id);
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refs INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS derived (
+            digest TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            text TEXT
+        ) WITHOUT ROWID;
+        -- Row ids for the full-text index, which needs integer keys
+        CREATE TABLE IF NOT EXISTS text_docs (
+            id INTEGER PRIMARY KEY,
+            digest TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            digest TEXT NOT NULL UNIQUE,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL DEFAULT 0,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, run_after);
+        CREATE TABLE IF NOT EXISTS catalog (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO catalog (id, version) VALUES (0, 0);
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_by_version ON changes (version);
+    """
+
+    # Columns added after the first release of this schema
+    MIGRATIONS = [
+        ('files', 'digest', 'ALTER TABLE files ADD COLUMN digest TEXT REFERENCES blobs(digest)'),
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.conn()
+        conn.executescript(self.SCHEMA)
+        for table, column, sql in self.MIGRATIONS:
+            if column not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                conn.execute(sql)
+        conn.execute('CREATE INDEX IF NOT EXISTS files_by_digest ON files (digest)')
+        try:
+            # One token per character, so that phrases find words of any length in
+            # unspaced Japanese; contentless, as the text itself is in derived
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS text_index USING fts5("
+                         "text, content='', tokenize='unicode61 remove_diacritics 0')")
+            self.text_index = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite lacks FTS5; full-text search will scan every text")
+            self.text_index = False
+        if self.text_index and conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+            # Databases from before text_index: index the text extracted so far
+            with self.transaction(bump=False) as conn:
+                if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+                    for digest, text in conn.execute('SELECT digest, text FROM derived '
+                                                     'WHERE text IS NOT NULL').fetchall():
+                        self._index_text(conn, digest, text)
+                    conn.execute('PRAGMA user_version = 1')
+
+    def conn(self):
+        # sqlite3 connections are per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, bump=True):
+        # bump=False for bookkeeping that doesn't change what /api/files shows
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if bump:
+                # First, so that _log() files changes under the new version
+                conn.execute('UPDATE catalog SET version = version + 1 WHERE id = 0')
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def all(self):
+        data = {}
+        rows = self.conn().execute(
+            'SELECT f.name, f.digest, b.size, f.added, d.data, t.tag FROM files f '
+            'LEFT JOIN blobs b ON b.digest = f.digest '
+            'LEFT JOIN derived d ON d.digest = f.digest '
+            'LEFT JOIN tags t ON t.file_id = f.id '
+            'ORDER BY f.id, t.pos')
+        for name, digest, size, added, derived, tag in rows:
+            entry = data.get(name)
+            if entry is None:
+                entry = data[name] = {"tags": [], "digest": digest, "size": size, "added": added,
+                                      "derived": json.loads(derived) if derived else None}
+            if tag is not None:
+                entry["tags"].append(tag)
+        return data
+
+    def lookup(self, name):
+        row = self.conn().execute('SELECT digest FROM files WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def blob_info(self, name):
+        row = self.conn().execute('SELECT digest, added FROM files WHERE name = ?', (name,)).fetchone()
+        return (row[0], row[1]) if row and row[0] else None
+
+    def _log(self, conn, op, name):
+        change_id = conn.execute('INSERT INTO changes (version, op, name) '
+                                 'SELECT version, ?, ? FROM catalog WHERE id = 0', (op, name)).lastrowid
+        if change_id % 256 == 0:
+            conn.execute('DELETE FROM changes WHERE id <= ?', (change_id - CHANGE_LOG_SIZE,))
+
+    def _set_tags(self, conn, file_id, tags):
+        conn.execute('DELETE FROM tags WHERE file_id = ?', (file_id,))
+        conn.executemany('INSERT OR IGNORE INTO tags (file_id, tag, pos) VALUES (?, ?, ?)',
+                         [(file_id, tag, pos) for pos, tag in enumerate(tags)])
+
+    def _put(self, conn, name, tags):
+        added = conn.execute('INSERT INTO files (name, added) VALUES (?, ?) ON CONFLICT (name) DO NOTHING',
+                             (name, datetime.now().timestamp())).rowcount
+        file_id = conn.execute('SELECT id FROM files WHERE name = ?', (name,)).fetchone()[0]
+        self._set_tags(conn, file_id, tags)
+        self._log(conn, 'add' if added else 'retag', name)
+
+    def put(self, name, tags):
+        with self.transaction() as conn:
+            self._put(conn, name, tags)
+
+    def add_file(self, filename, tags, digest, size, tmp_path):
+        # Slow copies to remote storage happen before taking the write lock
+        BLOBS.prepare(tmp_path, digest)
+        with self.transaction() as conn:
+            # files.digest references blobs, so the blob row goes in first
+            conn.execute('INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1) '
+                         'ON CONFLICT (digest) DO UPDATE SET refs = refs + 1', (digest, size))
+            refs = conn.execute('SELECT refs FROM blobs WHERE digest = ?', (digest,)).fetchone()[0]
+            for name in upload_name_candidates(filename):
+                if legacy_file_exists(name):
+                    continue
+                try:
+                    file_id = conn.execute(
+                        'INSERT INTO files (name, added, digest) VALUES (?, ?, ?)',
+                        (name, datetime.now().timestamp(), digest)).lastrowid
+                except sqlite3.IntegrityError:
+                    # UNIQUE(name): someone already has it, try the next candidate
+                    continue
+                break
+            self._set_tags(conn, file_id, tags)
+            self._log(conn, 'add', name)
+            # Placing the blob inside the write transaction keeps it in step
+            # with the refcount even if another worker drops the last ref
+            BLOBS.put(tmp_path, digest)
+        return name, refs > 1
+
+    def delete(self, name):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT digest FROM files WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return
+            conn.execute('DELETE FROM files WHERE name = ?', (name,))
+            self._log(conn, 'remove', name)
+            digest = row[0]
+            if digest is not None:
+                conn.execute('UPDATE blobs SET refs = refs - 1 WHERE digest = ?', (digest,))
+                if conn.execute('DELETE FROM blobs WHERE digest = ? AND refs <= 0',
+                                (digest,)).rowcount:
+                    BLOBS.delete(digest)
+
+    def adopt_file(self, name, digest, size, added, tmp_path):
+        BLOBS.prepare(tmp_path, digest)
+        with self.transaction() as conn:
+            row = conn.execute('SELECT id, digest FROM files WHERE name = ?', (name,)).fetchone()
+            if (row and row[1]) or not legacy_file_exists(name):
+                return False
+            conn.execute('INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1) '
+                         'ON CONFLICT (digest) DO UPDATE SET refs = refs + 1', (digest, size))
+            if row is None:
+                conn.execute('INSERT INTO files (name, added, digest) VALUES (?, ?, ?)',
+                             (name, added, digest))
+            else:
+                conn.execute('UPDATE files SET digest = ?, added = ? WHERE id = ?', (digest, added, row[0]))
+            self._log(conn, 'update', name)
+            BLOBS.put(tmp_path, digest)
+        return True
+
+    def version(self):
+        return self.conn().execute('SELECT version FROM catalog WHERE id = 0').fetchone()[0]
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def enqueue_job(self, digest):
+        with self.transaction(bump=False) as conn:
+            conn.execute('INSERT OR IGNORE INTO jobs (digest) SELECT ? '
+                         'WHERE NOT EXISTS (SELECT 1 FROM derived WHERE digest = ?)', (digest, digest))
+
+    def claim_job(self, lease):
+        now = time.time()
+        with self.transaction(bump=False) as conn:
+            # 'running' jobs whose lease ran out belonged to a worker that died
+            row = conn.execute("SELECT id, digest, attempts FROM jobs "
+                               "WHERE state IN ('pending', 'running') AND run_after <= ? "
+                               "ORDER BY run_after LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = 'running', run_after = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (now + lease, row[0]))
+        return row[0], row[1], row[2] + 1
+
+    def complete_job(self, job_id, digest, derived, text):
+        with self.transaction() as conn:
+            if derived is not None:
+                conn.execute('INSERT OR REPLACE INTO derived (digest, data, text) VALUES (?, ?, ?)',
+                             (digest, json.dumps(derived), text))
+                if text and self.text_index:
+                    self._index_text(conn, digest, text)
+                for (name,) in conn.execute('SELECT name FROM files WHERE digest = ?', (digest,)).fetchall():
+                    self._log(conn, 'update', name)
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def fail_job(self, job_id, error, retry_at):
+        with self.transaction(bump=False) as conn:
+            conn.execute('UPDATE jobs SET state = ?, run_after = ?, error = ? WHERE id = ?',
+                         ('failed' if retry_at is None else 'pending', retry_at or 0, error, job_id))
+
+    def changes(self, since):
+        conn = self.conn()
+        # One read transaction so the version and the rows agree
+        conn.execute('BEGIN')
+        try:
+            version = conn.execute('SELECT version FROM catalog WHERE id = 0').fetchone()[0]
+            oldest = conn.execute('SELECT min(version) FROM changes').fetchone()[0]
+            floor = version if oldest is None else oldest - 1
+            if since > version or since < floor:
+                # From another database, or older than the retained log
+                return version, None
+            rows = conn.execute('SELECT op, name FROM changes WHERE version > ? ORDER BY id',
+                                (since,)).fetchall()
+        finally:
+            conn.execute('COMMIT')
+        return version, rows
+
+    def _index_text(self, conn, digest, text):
+        # The same digest always has the same text, so it is indexed once
+        cur = conn.execute('INSERT OR IGNORE INTO text_docs (digest) VALUES (?)', (digest,))
+        if cur.rowcount:
+            conn.execute('INSERT INTO text_index (rowid, text) VALUES (?, ?)', (cur.lastrowid, ' '.join(text)))
+
+    def search_text(self, terms):
+        sql = 'SELECT digest FROM derived WHERE ' + ' AND '.join(['instr(text, ?) > 0'] * len(terms))
+        # A term of only punctuation would be an empty phrase, which never matches
+        phrases = ['"%s"' % ' '.join(term).replace('"', '""') for term in terms if any(c.isalnum() for c in term)]
+        if not (self.text_index and phrases):
+            return {row[0] for row in self.conn().execute(sql, terms)}
+        # Candidates from the index, then the exact substring test on just those
+        sql += (' AND digest IN (SELECT digest FROM text_docs WHERE id IN ('
+                'SELECT rowid FROM text_index WHERE text_index MATCH ?))')
+        return {row[0] for row in self.conn().execute(sql, terms + [' AND '.join(phrases)])}
+
+    def is_empty(self):
+        return self.conn().execute('SELECT 1 FROM files LIMIT 1').fetchone() is None
+
+    def import_json(self, path):
+        """Copy entries from a legacy data.json into this store; returns the count."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return 0
+        with self.transaction() as conn:
+            for name, meta in data.items():
+                self._put(conn, name, meta.get("tags", []))
+        return len(data)
+
+
+def open_metadata_store(backend, import_legacy=True):
+    if backend == 'json':
+        return JsonMetadataStore(DATA_FILE)
+    store = SqliteMetadataStore(DB_FILE)
+    if import_legacy and store.is_empty() and os.path.exists(DATA_FILE):
+        count = store.import_json(DATA_FILE)
+        logging.info(f"Imported {count} entries from {DATA_FILE} into {DB_FILE}")
+    return store
+
+
+METADATA = None
+
+
+ACCESS_LOG = logging.getLogger('access')
+LOG_QUEUE = None
+
+
+def setup_logging(level=LOG_LEVEL, log_file=LOG_FILE, access_log_file=ACCESS_LOG_FILE,
+                  max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, processes=1):
+    """Route all logging through a queue drained by one background listener.
+
+    Request threads only enqueue records; the QueueListener thread does the
+    formatting, disk writes and size-based rotation. With several worker
+    processes the queue is a multiprocessing.Queue drained in the supervisor,
+    so only one process ever rotates the files.
+    """
+    global LOG_QUEUE
+    server_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    server_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    server_handler.addFilter(lambda record: record.name != ACCESS_LOG.name)
+
+    access_handler = logging.handlers.RotatingFileHandler(
+        access_log_file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    access_handler.setFormatter(logging.Formatter('%(message)s'))
+    access_handler.addFilter(logging.Filter(ACCESS_LOG.name))
+
+    LOG_QUEUE = multiprocessing.Queue() if processes > 1 else queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(LOG_QUEUE, server_handler, access_handler)
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # Access records are written whatever --log-level says
+    ACCESS_LOG.setLevel(logging.INFO)
+    ACCESS_LOG.propagate = False
+    if processes > 1:
+        # The supervisor writes its own (rare) records directly, so that it
+        # never owns multiprocessing.Queue locks or threads at fork() time
+        root.handlers = [server_handler]
+        ACCESS_LOG.handlers = [access_handler]
+    else:
+        root.handlers = ACCESS_LOG.handlers = [logging.handlers.QueueHandler(LOG_QUEUE)]
+    return listener
+
+
+def log_access(handler, duration):
+    status = handler.response_status
+    if status < 400 and ACCESS_LOG_SAMPLE < 1 and random.random() >= ACCESS_LOG_SAMPLE:
+        return
+    ACCESS_LOG.info(json.dumps({
+        "time": datetime.now().isoformat(timespec='milliseconds'),
+        "client": handler.client_address[0],
+        "method": handler.command,
+        "path": handler.request_path,
+        "status": status,
+        "bytes": handler.response_bytes,
+        "duration_ms": round(duration * 1000, 2),
+        "pid": os.getpid(),
+    }, ensure_ascii=False))
+
+
+class Metric:
+    """Base for the small Prometheus-style metrics below; label values key each series."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+        METRICS.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def label_text(self, key, extra=''):
+        pairs = ['%s="%s"' % (l, v.replace('\\', '\\\\').replace('"', '\\"'))
+                 for l, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = list(self.series.items())
+        for key, value in series:
+            lines.extend(self.render_series(key, value))
+        return lines
+
+    def render_series(self, key, value):
+        return [f"{self.name}{self.label_text(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_series(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = self.label_text(key, 'le="%s"' % bound)
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        le = self.label_text(key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{le} {count}")
+        lines.append(f"{self.name}_sum{self.label_text(key)} {total}")
+        lines.append(f"{self.name}_count{self.label_text(key)} {count}")
+        return lines
+
+
+METRICS = []
+REQUESTS = Counter('kakomon_requests_total', 'HTTP requests handled', ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('kakomon_request_duration_seconds', 'Time spent handling a request', ('route', 'method'))
+IN_FLIGHT = Gauge('kakomon_requests_in_flight', 'Requests currently being handled')
+BYTES_IN = Counter('kakomon_request_bytes_total', 'Request body bytes received', ('route',))
+BYTES_OUT = Counter('kakomon_response_bytes_total', 'Response body bytes sent', ('route',))
+UPLOAD_BYTES = Counter('kakomon_upload_bytes_total', 'Bytes of uploaded files stored')
+UPLOAD_SECONDS = Histogram('kakomon_upload_duration_seconds', 'Time to receive and store an upload')
+JOBS = Counter('kakomon_jobs_total', 'Background jobs finished', ('result',))
+JOB_SECONDS = Histogram('kakomon_job_duration_seconds', 'Time spent running a background job')
+BLOB_CACHE = Counter('kakomon_blob_cache_total', 'Blob reads by the cache tier that served them', ('result',))
+REJECTED = Counter('kakomon_rejected_requests_total', 'Requests turned away by admission control',
+                   ('route', 'reason'))
+PHASE_SECONDS = Histogram('kakomon_phase_duration_seconds', 'Time spent in named request phases', ('phase',))
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def route_label(path):
+    # Keep label cardinality fixed: one value per API route plus a few buckets
+    path = urllib.parse.urlsplit(path or '').path
+    if path.startswith('/api/uploads/'):
+        return '/api/uploads'
+    if path.startswith('/api/'):
+        return path if path in API_ROUTES else 'api_other'
+    if path.startswith(('/uploads/', '/public/uploads/')):
+        return 'uploads'
+    return 'static'
+
+
+def instrumented(method):
+    """Record latency, status, in-flight and byte metrics around a do_* method."""
+    @functools.wraps(method)
+    def wrapper(self):
+        route = route_label(self.request_path)
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            return method(self)
+        finally:
+            IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=self.command)
+            REQUESTS.inc(route=route, method=self.command, status=self.response_status)
+            BYTES_IN.inc(int(self.headers.get('Content-Length') or 0), route=route)
+            BYTES_OUT.inc(self.response_bytes, route=route)
+    return wrapper
+
+
+def normalize_request_path(target):
+    """Resolve '.', '..' and empty segments in a request target's path; None if it is unsafe.
+
+    Segments keep their percent-encoding, but an encoded dot segment or one
+    that decodes to a slash is caught here rather than in translate_path().
+    """
+    path, sep, query = target.partition('?')
+    segments = []
+    for segment in path.split('/'):
+        decoded = urllib.parse.unquote(segment)
+        if '/' in decoded or '\\' in decoded or '\0' in decoded:
+            return None
+        if decoded in ('', '.'):
+            continue
+        if decoded == '..':
+            if segments:
+                segments.pop()
+            continue
+        segments.append(segment)
+    normalized = '/' + '/'.join(segments)
+    if segments and path.endswith('/'):
+        normalized += '/'
+    return normalized + sep + query
+
+
+class DiscardWriter:
+    """Stands in for wfile after the headers of a HEAD response."""
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def cookie_value(header, name):
+    """Find one cookie in a Cookie header without a full SimpleCookie parse."""
+    prefix = name + '='
+    for part in header.split(';'):
+        part = part.strip()
+        if part.startswith(prefix):
+            return part[len(prefix):].strip('"')
+    return None
+
+
+def session_cookie(token, max_age=None):
+    c = http.cookies.SimpleCookie()
+    c[SESSION_COOKIE_NAME] = token
+    c[SESSION_COOKIE_NAME]["path"] = "/"
+    c[SESSION_COOKIE_NAME]["httponly"] = True
+    c[SESSION_COOKIE_NAME]["samesite"] = "Lax"
+    if max_age is not None:
+        c[SESSION_COOKIE_NAME]["max-age"] = max_age
+    return c.output(header='').strip()
+
+
+class MemorySessionStore:
+    """Sessions held in this process with sliding expiry and LRU eviction."""
+
+    cookie_max_age = None
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self):
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self.lock:
+            # Least recently used first, which is also soonest to expire
+            while self.sessions and (len(self.sessions) >= self.max_sessions
+                                     or next(iter(self.sessions.values())) < now):
+                self.sessions.popitem(last=False)
+            self.sessions[token] = now + self.ttl
+        return token
+
+    def validate(self, token):
+        """Return (valid, renewed_token); renewed_token is None when the cookie can stay."""
+        now = time.monotonic()
+        with self.lock:
+            expires = self.sessions.get(token)
+            if expires is None:
+                return False, None
+            if expires < now:
+                del self.sessions[token]
+                return False, None
+            self.sessions[token] = now + self.ttl
+            self.sessions.move_to_end(token)
+        return True, None
+
+
+class SignedSessionStore:
+    """Stateless HMAC-signed tokens that any worker sharing the secret can verify.
+
+    A token is ``<expires>.<nonce>.<signature>``. Tokens past half their
+    lifetime are reissued so active users keep a sliding expiry.
+    """
+
+    def __init__(self, secret, ttl=SESSION_TTL):
+        self.secret = secret
+        self.ttl = ttl
+        self.cookie_max_age = ttl
+
+    def _sign(self, payload):
+        digest = hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def create(self):
+        payload = f"{int(time.time()) + self.ttl}.{secrets.token_urlsafe(9)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def validate(self, token):
+        # compare_digest() raises on non-ASCII str; such a cookie is just invalid
+        if not token.isascii():
+            return False, None
+        payload, _, signature = token.rpartition('.')
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return False, None
+        try:
+            expires = int(payload.split('.', 1)[0])
+        except ValueError:
+            return False, None
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return False, None
+        if remaining < self.ttl / 2:
+            return True, self.create()
+        return True, None
+
+
+def load_session_secret(path=SESSION_SECRET_FILE):
+    """Read the signing key, creating it (mode 0600) on first use."""
+    public = os.path.realpath(PUBLIC_DIR)
+    if os.path.commonpath([public, os.path.realpath(path)]) == public:
+        raise ValueError(f"session key {path} is inside the served directory {PUBLIC_DIR}")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read()
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+def open_session_store(backend, ttl=SESSION_TTL, key_file=SESSION_SECRET_FILE):
+    if backend == 'signed':
+        return SignedSessionStore(load_session_secret(key_file), ttl)
+    return MemorySessionStore(ttl)
+
+
+SESSIONS = MemorySessionStore()
+
+def normalize_text(text):
+    # NFKC folds full-width/half-width forms (ＰＤＦ, ｶﾀｶﾅ) before case-folding
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def name_grams(text):
+    """Unigrams and bigrams of an already normalized string."""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class Listing:
+    """Immutable snapshot of the file list with search indexes.
+
+    ``by_tag`` maps a normalized tag to the positions of files carrying it
+    and ``by_gram`` maps every 1- and 2-character substring of a normalized
+    name to the files containing it. Positions refer to ``files``, which is
+    in newest-first order.
+    """
+
+    SORTS = {
+        'date': None,
+        'name': lambda f: normalize_text(f["name"]),
+        'size': lambda f: -f["size"],
+    }
+
+    def __init__(self, files):
+        self.files = files
+        self.entries = []
+        for f in files:
+            entry = {
+                "name": f["name"],
+                "size": f["size"],
+                "date": datetime.fromtimestamp(f["mtime"]).strftime("%Y-%m-%d %H:%M"),
+                "tags": f["tags"]
+            }
+            # Filled in by the post-upload job: checksum, pages, image size...
+            if f.get("derived"):
+                entry["meta"] = f["derived"]
+            self.entries.append(entry)
+        self.digests = [f.get("digest") for f in files]
+        self.by_name = {f["name"]: i for i, f in enumerate(files)}
+        # Catalog version the snapshot was built from; set by FileIndex
+        self.version = None
+        self.body = json.dumps(self.entries).encode()
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:20]
+        self._gzip_body = None
+
+        self.keys = []
+        self.by_tag = {}
+        self.by_gram = {}
+        for i, f in enumerate(files):
+            key = normalize_text(f["name"])
+            self.keys.append(key)
+            for tag in {normalize_text(t) for t in f["tags"]}:
+                self.by_tag.setdefault(tag, []).append(i)
+            for gram in name_grams(key):
+                self.by_gram.setdefault(gram, []).append(i)
+
+        # Per sort: the file positions in display order, and each file's rank in it
+        self.orders = {}
+        self.ranks = {}
+        for sort, key in self.SORTS.items():
+            if key is None:
+                self.orders[sort] = range(len(files))
+                continue
+            order = sorted(range(len(files)), key=lambda i: key(files[i]))
+            rank = [0] * len(files)
+            for r, i in enumerate(order):
+                rank[i] = r
+            self.orders[sort] = order
+            self.ranks[sort] = rank
+
+    def gzip_body(self):
+        # Compressed once per snapshot, on first request that accepts it
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self._gzip_body
+
+    def _candidates(self, postings):
+        # Intersect posting lists, smallest first
+        postings = sorted(postings, key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            result.intersection_update(p)
+            if not result:
+                break
+        return result
+
+    def search(self, query='', tags=(), sort='date', offset=0, limit=100, digests=None):
+        """Return (total, entries) for the requested page.
+
+        ``digests``, if given, are blobs whose extracted text matched the
+        query; those files match as well as the ones whose name does.
+        """
+        terms = normalize_text(query).split()
+        tag_postings = [self.by_tag.get(normalize_text(tag), []) for tag in tags]
+        postings = list(tag_postings)
+        for term in terms:
+            grams = [term] if len(term) <= 2 else [term[i:i + 2] for i in range(len(term) - 1)]
+            postings.extend(self.by_gram.get(g, []) for g in set(grams))
+
+        if not postings:
+            order = self.orders[sort]
+            return len(self.files), [self.entries[i] for i in order[offset:offset + limit]]
+
+        matches = self._candidates(postings)
+        # Bigrams can match out of order; confirm the real substring
+        matches = [i for i in matches if all(t in self.keys[i] for t in terms if len(t) > 2)]
+        if digests:
+            by_text = [i for i, d in enumerate(self.digests) if d in digests]
+            if tag_postings:
+                by_text = self._candidates(tag_postings + [by_text])
+            matches = list(set(matches).union(by_text))
+        if sort == 'date':
+            matches.sort()
+        else:
+            matches.sort(key=self.ranks[sort].__getitem__)
+        return len(matches), [self.entries[i] for i in matches[offset:offset + limit]]
+
+
+class FileIndex:
+    """Resident copy of the /api/files listing.
+
+    The listing is rebuilt only when UPLOAD_DIR (by mtime) or the metadata
+    store change, or after invalidate(); otherwise the current Listing, with
+    its pre-encoded JSON body and ETag, is returned as is.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.listing = Listing([])
+
+    def invalidate(self):
+        self.stamp = None
+
+    def _stamp(self):
+        try:
+            dir_mtime = os.stat(UPLOAD_DIR).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        return dir_mtime, METADATA.version()
+
+    def get(self):
+        stamp = self._stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                with PHASE_SECONDS.time(phase='listing_build'):
+                    pruned = self._rebuild()
+                if pruned:
+                    # We pruned the metadata ourselves; don't rebuild again for that
+                    stamp = self._stamp()
+                self.stamp = stamp
+                self.listing.version = stamp[1]
+            return self.listing
+
+    def _rebuild(self):
+        files = []
+        pruned = False
+        file_data = METADATA.all()
+        with os.scandir(UPLOAD_DIR) as it:
+            real_files = {entry.name: entry for entry in it}
+
+        for fname, meta in file_data.items():
+            if meta["digest"]:
+                files.append({
+                    "name": fname,
+                    "size": meta["size"],
+                    "mtime": meta["added"],
+                    "tags": meta["tags"],
+                    "digest": meta["digest"],
+                    "derived": meta["derived"]
+                })
+            elif fname not in real_files:
+                METADATA.delete(fname)
+                pruned = True
+
+        # Files uploaded before content addressing
+        for fname, entry in real_files.items():
+            if fname in file_data and file_data[fname]["digest"]: continue
+            if not is_legacy_upload(entry): continue
+            try:
+                stat = entry.stat()
+                meta = file_data.get(fname, {"tags": []})
+
+                files.append({
+                    "name": fname,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "tags": meta.get("tags", [])
+                })
+            except OSError:
+                continue
+
+        files.sort(key=lambda x: x['mtime'], reverse=True)
+        self.listing = Listing(files)
+        return pruned
+
+
+FILE_INDEX = FileIndex()
+
+
+PDF_STREAM = re.compile(rb'stream\r?\n(.*?)\r?\nendstream', re.S)
+PDF_PAGE = re.compile(rb'/Type\s*/Page(?![s\w])')
+PDF_TEXT = re.compile(rb'\((?:\\.|[^\\)])*\)\s*Tj|\[(?:[^\]]*)\]\s*TJ', re.S)
+PDF_STRING = re.compile(rb'\(((?:\\.|[^\\)])*)\)', re.S)
+PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+
+def pdf_string(raw):
+    def unescape(m):
+        c = m.group(1)
+        if c[:1].isdigit():
+            return bytes([int(c, 8) & 0xff])
+        return PDF_ESCAPES.get(c, c)
+    return re.sub(rb'\\([0-7]{1,3}|.)', unescape, raw, flags=re.S)
+
+
+def pdf_info(data):
+    """Page count and text drawn by Tj/TJ operators, from raw and Flate streams."""
+    pages = len(PDF_PAGE.findall(data))
+    pieces = []
+    # Inflated output is capped per file so a small Flate bomb cannot exhaust memory
+    budget = MAX_EXTRACT_BYTES
+    for m in PDF_STREAM.finditer(data):
+        stream = m.group(1)
+        if budget > 0:
+            try:
+                stream = zlib.decompressobj().decompress(stream, budget)
+                budget -= len(stream)
+            except zlib.error:
+                pass
+        # Object streams hide page dictionaries inside compressed data
+        pages += len(PDF_PAGE.findall(stream))
+        for op in PDF_TEXT.finditer(stream):
+            pieces.extend(pdf_string(s) for s in PDF_STRING.findall(op.group(0)))
+    text = b' '.join(pieces).decode('latin-1')
+    return pages, text
+
+
+def image_size(head):
+    """(width, height) of a PNG, GIF or JPEG from its first bytes, or None."""
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head.startswith(b'\xff\xd8'):
+        i = 2
+        while i + 9 < len(head):
+            if head[i] != 0xff:
+                i += 1
+                continue
+            marker = head[i + 1]
+            if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7 or marker == 0xff:
+                i += 1 if marker == 0xff else 2
+                continue
+            length = struct.unpack('>H', head[i + 2:i + 4])[0]
+            # SOF0..SOF15 except DHT, JPG and DAC carry the frame size
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', head[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+    return None
+
+
+def extract_derived(path):
+    """Work out what /api/files shows about a blob: (derived dict, searchable text).
+
+    Runs in a job worker (thread or process), never in a request.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        head = f.read(256 * 1024)
+        md5.update(head)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE * 16), b''):
+            md5.update(chunk)
+    derived = {"md5": md5.hexdigest()}
+    text = None
+
+    if head.startswith(b'%PDF-'):
+        with open(path, 'rb') as f:
+            pages, text = pdf_info(f.read(MAX_EXTRACT_BYTES))
+        derived["type"] = "pdf"
+        derived["pages"] = pages
+    elif (size := image_size(head)) is not None:
+        derived["type"] = "image"
+        derived["width"], derived["height"] = size
+    else:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read(MAX_TEXT_CHARS)
+            derived["type"] = "text"
+        except (UnicodeDecodeError, ValueError):
+            pass
+
+    if text:
+        text = normalize_text(' '.join(text.split()))[:MAX_TEXT_CHARS]
+        derived["text_chars"] = len(text)
+    return derived, text or None
+
+
+class JobRunner:
+    """Bounded pool running post-upload jobs from the metadata store's queue.
+
+    Jobs live in the store, so pending ones survive a restart and a job
+    leased by a worker that died is picked up again once its lease runs
+    out. In 'process' mode extraction runs in a process pool of the same
+    size so PDF parsing doesn't compete with request threads for the GIL.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, mode=JOB_MODE):
+        self.workers = workers
+        self.executor = None
+        if mode == 'process' and workers:
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        for t in self.threads:
+            t.join(SHUTDOWN_GRACE)
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                job = METADATA.claim_job(JOB_LEASE)
+            except Exception:
+                logging.exception("Could not claim a job")
+                job = None
+            if job is None:
+                self.wakeup.wait(JOB_POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            self.run(*job)
+
+    def run(self, job_id, digest, attempts):
+        started = time.perf_counter()
+        try:
+            path = BLOBS.local_path(digest)
+            if path is None:
+                # Deleted since it was queued; nothing left to do
+                derived, text = None, None
+            elif self.executor:
+                derived, text = self.executor.submit(extract_derived, path).result()
+            else:
+                derived, text = extract_derived(path)
+            METADATA.complete_job(job_id, digest, derived, text)
+        except Exception as e:
+            retry_at = None
+            if attempts < MAX_JOB_ATTEMPTS:
+                retry_at = time.time() + JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            logging.warning(f"Job for {digest} failed (attempt {attempts}): {e!r}"
+                            f"{'' if retry_at else ', giving up'}")
+            METADATA.fail_job(job_id, repr(e), retry_at)
+            JOBS.inc(result='retry' if retry_at else 'failed')
+            return
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started)
+        logging.debug("Job for %s done: %s", digest, derived)
+        FILE_INDEX.invalidate()
+        EVENT_HUB.notify()
+        JOBS.inc(result='done')
+
+
+def enqueue_missing_jobs():
+    """Queue extraction for blobs stored before jobs existed or whose job was lost."""
+    count = 0
+    for meta in METADATA.all().values():
+        if meta["digest"] and meta["derived"] is None:
+            METADATA.enqueue_job(meta["digest"])
+            count += 1
+    return count
+
+
+def migrate_uploads():
+    """Bring old files into the current storage layout.
+
+    Flat blobs move into their shard directories, files kept directly in
+    UPLOAD_DIR are adopted into the blob store, and with remote storage
+    configured, blobs still on local disk are copied there (the local
+    copies stay until removed by hand). Safe to run next to a live server:
+    /uploads/<name> keeps resolving throughout, since a file is only
+    removed from its old place once the new one is in place. Returns
+    (blobs moved, blobs copied, uploads adopted).
+    """
+    local = BLOBS if isinstance(BLOBS, LocalBlobStore) else LocalBlobStore(BLOB_DIR)
+    moved = local.reshard()
+
+    copied = 0
+    if local is not BLOBS:
+        remote = BLOBS.backend if isinstance(BLOBS, BlobCache) else BLOBS
+        for digest in local.digests():
+            if remote.exists(digest):
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, prefix='.upload-')
+            os.close(fd)
+            shutil.copyfile(local.local_path(digest), tmp_path)
+            remote.put(tmp_path, digest)
+            copied += 1
+
+    adopted = 0
+    with os.scandir(UPLOAD_DIR) as it:
+        legacy = [(entry.name, entry.stat().st_mtime) for entry in it if is_legacy_upload(entry)]
+    for name, mtime in legacy:
+        if METADATA.lookup(name):
+            continue
+        fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, prefix='.upload-')
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with open(os.path.join(UPLOAD_DIR, name), 'rb') as src, os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE * 16), b''):
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = sha.hexdigest()
+            if not METADATA.adopt_file(name, digest, size, mtime, tmp_path):
+                os.remove(tmp_path)
+                continue
+        except OSError:
+            logging.exception(f"Could not migrate {name}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            continue
+        os.remove(os.path.join(UPLOAD_DIR, name))
+        METADATA.enqueue_job(digest)
+        adopted += 1
+    return moved, copied, adopted
+
+
+JOB_RUNNER = JobRunner(0)
+
+
+class MultipartStream:
+    """Incremental multipart/form-data reader.
+
+    Reads at most ``length`` bytes from ``rfile`` in CHUNK_SIZE pieces and
+    never holds more than one chunk plus a boundary in memory, so upload
+    size does not affect memory use.
+    """
+
+    def __init__(self, rfile, length, boundary):
+        self.rfile = rfile
+        self.remaining = length
+        self.delimiter = b'\r\n--' + boundary
+        # The first boundary has no leading CRLF; pretend it does
+        self.buf = b'\r\n'
+
+    def _fill(self):
+        if self.remaining <= 0:
+            raise ValueError("Multipart body ended before closing boundary")
+        data = self.rfile.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise ValueError("Connection closed during upload")
+        self.remaining -= len(data)
+        self.buf += data
+
+    def _body(self):
+        keep = len(self.delimiter) - 1
+        while True:
+            idx = self.buf.find(self.delimiter)
+            if idx >= 0:
+                if idx:
+                    yield self.buf[:idx]
+                self.buf = self.buf[idx + len(self.delimiter):]
+                return
+            # Hold back a tail that might be the start of a split delimiter
+            if len(self.buf) > keep:
+                yield self.buf[:-keep]
+                self.buf = self.buf[-keep:]
+            self._fill()
+
+    def read_field(self, body, limit=MAX_FIELD_SIZE):
+        data = b''
+        for chunk in body:
+            data += chunk
+            if len(data) > limit:
+                raise ValueError("Form field too large")
+        return data
+
+    def parts(self):
+        """Yield (headers, body) per part; body is an iterator of byte chunks."""
+        # Skip the preamble
+        for _ in self._body():
+            pass
+
+        while True:
+            while len(self.buf) < 2:
+                self._fill()
+            if self.buf.startswith(b'--'):
+                # Closing boundary; discard the epilogue
+                while self.remaining > 0:
+                    self.remaining -= len(self.rfile.read(min(CHUNK_SIZE, self.remaining)))
+                return
+
+            while (end := self.buf.find(b'\r\n\r\n')) < 0:
+                if len(self.buf) > MAX_FIELD_SIZE:
+                    raise ValueError("Multipart headers too large")
+                self._fill()
+            # Drop whatever follows the boundary on its own line (CRLF, padding)
+            header_block = self.buf[self.buf.find(b'\r\n') + 2:end + 4]
+            self.buf = self.buf[end + 4:]
+            headers = BytesParser(policy=default).parsebytes(header_block)
+
+            body = self._body()
+            yield headers, body
+            # Make sure the caller's unread data is skipped
+            for _ in body:
+                pass
+
+
+def body_limit(command, path):
+    """Largest request body accepted for a route."""
+    if command == 'POST' and path == '/api/upload':
+        return MAX_UPLOAD_BYTES
+    if command == 'PUT' and path.startswith('/api/uploads/'):
+        return MAX_UPLOAD_CHUNK
+    return MAX_FIELD_SIZE
+
+
+class RateLimiter:
+    """Token buckets per client key: ``per_minute`` requests, bursts of up to ``burst``.
+
+    Buckets live in this process only, so with --workers N a client can get
+    up to N times the rate. The least recently seen keys are dropped past
+    MAX_RATE_KEYS.
+    """
+
+    def __init__(self, per_minute, burst, max_keys=MAX_RATE_KEYS, clock=time.monotonic):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token; return 0 if allowed, else the seconds until one is available."""
+        now = self.clock()
+        with self.lock:
+            tokens, stamp = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate if self.rate else 60
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+RATE_LIMITERS = {}
+UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_INFLIGHT_UPLOADS)
+
+
+def configure_admission(max_upload_bytes, max_inflight_uploads, login_rate, upload_rate, trusted_proxies=()):
+    global MAX_UPLOAD_BYTES, UPLOAD_SLOTS, TRUSTED_PROXIES
+    MAX_UPLOAD_BYTES = max_upload_bytes
+    TRUSTED_PROXIES = tuple(trusted_proxies)
+    UPLOAD_SLOTS = threading.BoundedSemaphore(max_inflight_uploads)
+    RATE_LIMITERS.clear()
+    if login_rate:
+        RATE_LIMITERS['/api/login'] = RateLimiter(login_rate, LOGIN_RATE[1])
+    if upload_rate:
+        # One bucket for both ways of starting an upload
+        RATE_LIMITERS['/api/upload'] = RATE_LIMITERS['/api/uploads'] = RateLimiter(upload_rate, UPLOAD_RATE[1])
+
+
+configure_admission(MAX_UPLOAD_BYTES, MAX_INFLIGHT_UPLOADS, LOGIN_RATE[0], UPLOAD_RATE[0])
+
+
+def parse_catalog_version(text):
+    """A catalog version from a client, as an int SQLite can bind; ValueError otherwise."""
+    version = int(text)
+    if not 0 <= version < 2 ** 63:
+        raise ValueError(text)
+    return version
+
+
+def catalog_changes(since):
+    """Return (version, changes) since a catalog version, or (version, None) to reload.
+
+    Each change is the last thing that happened to a name: "remove" with
+    just the name, or "add"/"retag"/"update" with its current /api/files entry.
+    """
+    version, rows = METADATA.changes(since)
+    if rows is None:
+        return version, None
+    latest = {}
+    for op, name in rows:
+        previous = latest.pop(name, None)
+        # New since the client last looked: still an add, whatever followed
+        latest[name] = 'add' if previous == 'add' and op != 'remove' else op
+    listing = FILE_INDEX.get()
+    changes = []
+    for name, op in latest.items():
+        i = listing.by_name.get(name)
+        if i is None:
+            changes.append({"op": "remove", "name": name})
+        else:
+            changes.append({"op": "remove" if op == "remove" else op, "name": name,
+                            "file": listing.entries[i]})
+    return version, changes
+
+
+def encode_events(since):
+    """The /api/events messages bringing a subscriber from ``since`` to now."""
+    version, changes = catalog_changes(since)
+    if changes is None:
+        return version, b'id: %d\nevent: reset\ndata: {}\n\n' % version
+    messages = ['event: %s\ndata: %s\n\n' % (c["op"], json.dumps(c)) for c in changes]
+    # The id goes last, so a client cut off mid-batch resumes before it
+    messages.append('id: %d\nevent: version\ndata: {"version": %d}\n\n' % (version, version))
+    return version, ''.join(messages).encode()
+
+
+class EventHub:
+    """Serves every /api/events subscriber of this process from one thread.
+
+    The request handler sends the response headers, hands its socket over
+    and returns, so an idle subscriber costs a file descriptor rather than
+    a worker thread. Changes made here wake the thread through notify();
+    changes made by other worker processes are caught by comparing the
+    catalog version every EVENT_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}   # socket -> catalog version it has seen
+        self.pending = []
+        self.thread = None
+
+    def _start(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, name='events', daemon=True)
+        self.thread.start()
+
+    def owns(self, sock):
+        with self.lock:
+            return sock in self.clients
+
+    def full(self):
+        return len(self.clients) >= MAX_EVENT_CLIENTS
+
+    def attach(self, sock, since):
+        with self.lock:
+            # Started lazily so each pre-forked worker gets its own thread
+            if self.thread is None:
+                self._start()
+            sock.setblocking(False)
+            self.clients[sock] = since
+            self.pending.append(sock)
+        self.notify()
+
+    def notify(self):
+        if self.thread is not None:
+            try:
+                self.wake_w.send(b'x')
+            except OSError:
+                pass
+
+    def _run(self):
+        last_ping = time.monotonic()
+        while True:
+            for key, _ in self.selector.select(EVENT_POLL_INTERVAL):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    # Subscribers never send anything; readable means gone
+                    self._drop(key.fileobj)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for sock in pending:
+                self.selector.register(sock, selectors.EVENT_READ)
+            try:
+                self._publish()
+            except Exception:
+                logging.exception("Could not publish catalog changes")
+            if time.monotonic() - last_ping >= EVENT_KEEPALIVE:
+                last_ping = time.monotonic()
+                with self.lock:
+                    clients = list(self.clients)
+                for sock in clients:
+                    self._send(sock, b': ping\n\n')
+
+    def _publish(self):
+        version = METADATA.version()
+        behind = {}
+        with self.lock:
+            clients = list(self.clients.items())
+        for sock, seen in clients:
+            if seen != version:
+                behind.setdefault(seen, []).append(sock)
+        # One query per distinct starting point, not per subscriber
+        for since, socks in behind.items():
+            if since is None:
+                latest, payload = version, b''
+            else:
+                latest, payload = encode_events(since)
+            for sock in socks:
+                if self._send(sock, payload):
+                    with self.lock:
+                        if sock in self.clients:
+                            self.clients[sock] = latest
+
+    def _send(self, sock, data):
+        try:
+            if sock.send(data) == len(data):
+                return True
+        except OSError:
+            pass
+        # Too slow to keep up or gone; it reconnects with Last-Event-ID
+        self._drop(sock)
+        return False
+
+    def _drop(self, sock):
+        with self.lock:
+            self.clients.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+
+EVENT_HUB = EventHub()
+
+
+class UploadSessionError(Exception):
+    def __init__(self, status, message, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+class ChunkedUploads:
+    """Resumable uploads sent as byte ranges, possibly in parallel.
+
+    Each upload is three files in ``root``: <id>.json (name, size, tags),
+    <id>.part (preallocated, written at each chunk's offset) and <id>.ranges,
+    an append-only log of the ranges written so far. A range is logged only
+    after its bytes are in the .part file, and one-line O_APPEND writes
+    don't interleave, so chunks need no lock even across worker processes.
+    """
+
+    ID = re.compile(r'[0-9a-f]{32}')
+
+    def __init__(self, root):
+        self.root = root
+        self.last_sweep = 0
+
+    def _path(self, upload_id, ext):
+        if not self.ID.fullmatch(upload_id):
+            raise UploadSessionError(404, "No such upload")
+        return os.path.join(self.root, upload_id + ext)
+
+    def create(self, filename, size, tags):
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        with open(self._path(upload_id, '.part'), 'wb') as f:
+            f.truncate(size)
+        open(self._path(upload_id, '.ranges'), 'wb').close()
+        # Written last: an upload exists once its .json does
+        tmp_path = self._path(upload_id, '.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({"filename": filename, "size": size, "tags": tags,
+                       "created": time.time()}, f)
+        os.replace(tmp_path, self._path(upload_id, '.json'))
+        return upload_id
+
+    def info(self, upload_id):
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            raise UploadSessionError(404, "No such upload")
+        info["id"] = upload_id
+        info["received"] = self.received(upload_id)
+        return info
+
+    def received(self, upload_id):
+        """Merged list of [start, end) ranges written so far."""
+        try:
+            with open(self._path(upload_id, '.ranges'), 'rb') as f:
+                ranges = sorted(tuple(map(int, line.split())) for line in f if line.strip())
+        except FileNotFoundError:
+            return []
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def write(self, upload_id, offset, length, rfile):
+        info = self.info(upload_id)
+        if length > MAX_UPLOAD_CHUNK:
+            raise UploadSessionError(413, "Chunk too large")
+        if offset < 0 or offset + length > info["size"]:
+            raise UploadSessionError(416, "Chunk outside the file")
+        try:
+            fd = os.open(self._path(upload_id, '.part'), os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadSessionError(404, "No such upload")
+        pos = offset
+        gone = False
+        try:
+            remaining = length
+            while remaining:
+                chunk = rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise UploadSessionError(400, "Incomplete chunk")
+                os.pwrite(fd, chunk, pos)
+                pos += len(chunk)
+                remaining -= len(chunk)
+        finally:
+            os.close(fd)
+            # Keep whatever arrived before a dropped connection
+            if pos > offset:
+                try:
+                    log = os.open(self._path(upload_id, '.ranges'), os.O_WRONLY | os.O_APPEND)
+                except FileNotFoundError:
+                    # Finalized or aborted meanwhile; an error already under way wins
+                    gone = True
+                else:
+                    try:
+                        os.write(log, b"%d %d\n" % (offset, pos))
+                    finally:
+                        os.close(log)
+        if gone:
+            raise UploadSessionError(404, "No such upload")
+        return self.received(upload_id)
+
+    def finalize(self, upload_id):
+        """Claim a complete upload; return (info, digest, tmp_path) for add_file."""
+        info = self.info(upload_id)
+        if info["received"] != [[0, info["size"]]]:
+            raise UploadSessionError(409, "Upload incomplete", info["received"])
+        tmp_path = self._path(upload_id, '.final')
+        try:
+            # Only one of several concurrent finalize calls gets the file
+            os.rename(self._path(upload_id, '.part'), tmp_path)
+        except FileNotFoundError:
+            raise UploadSessionError(404, "No such upload")
+        sha = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE * 16), b''):
+                sha.update(chunk)
+        self._remove(upload_id, ('.json', '.ranges'))
+        return info, sha.hexdigest(), tmp_path
+
+    def abort(self, upload_id):
+        self.info(upload_id)
+        self._remove(upload_id, ('.json', '.ranges', '.part'))
+
+    def _remove(self, upload_id, exts):
+        for ext in exts:
+            try:
+                os.remove(self._path(upload_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, force=False):
+        """Delete uploads with no activity for UPLOAD_SESSION_TTL."""
+        now = time.time()
+        if not force and now - self.last_sweep < UPLOAD_SWEEP_INTERVAL:
+            return 0
+        self.last_sweep = now
+        latest = {}
+        with os.scandir(self.root) as it:
+            for entry in it:
+                upload_id = entry.name.split('.', 1)[0]
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                latest[upload_id] = max(latest.get(upload_id, 0), mtime)
+        expired = [u for u, mtime in latest.items()
+                   if mtime < now - UPLOAD_SESSION_TTL and self.ID.fullmatch(u)]
+        for upload_id in expired:
+            self._remove(upload_id, ('.json', '.ranges', '.part', '.json.tmp', '.final'))
+        if expired:
+            logging.info(f"Removed {len(expired)} abandoned uploads")
+        return len(expired)
+
+
+CHUNKED_UPLOADS = ChunkedUploads(UPLOAD_SESSION_DIR)
+
+
+def sweep_upload_files(max_age=STALE_UPLOAD_AGE):
+    """Delete .upload-* temp files in BLOB_DIR not written to for ``max_age`` seconds."""
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(BLOB_DIR) as it:
+        for entry in it:
+            if not entry.name.startswith('.upload-'):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    if removed:
+        logging.info(f"Removed {removed} temp files left by interrupted uploads")
+    return removed
+
+
+def is_compressible(ctype):
+    # Everything else (JPEG, PDF, ZIP, ...) is already compressed or binary
+    return ctype.startswith(COMPRESSIBLE_TYPES)
+
+
+class GzipCache:
+    """Bounded in-memory cache of gzip-compressed file contents.
+
+    Entries are keyed by path and remember the mtime and size they were
+    built from, so an edited file is recompressed on its next request.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, f, stamp):
+        """Return the compressed contents of open file ``f``, or None if not worth it.
+
+        ``stamp`` names the version of ``path`` that ``f`` holds; a different one recompresses.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(path)
+                return entry[1]
+
+        f.seek(0)
+        raw = f.read()
+        data = gzip.compress(raw, compresslevel=6, mtime=0)
+        if len(data) >= len(raw):
+            data = None
+
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.total -= len(old[1] or b'')
+            self.entries[path] = (stamp, data)
+            self.total += len(data or b'')
+            while self.total > self.limit and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total -= len(evicted or b'')
+        return data
+
+    def warm(self, root, skip=()):
+        """Compress every eligible file under ``root`` ahead of the first request."""
+        skip = [os.path.abspath(p) for p in skip]
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) not in skip]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                ctype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+                try:
+                    with open(path, 'rb') as f:
+                        st = os.fstat(f.fileno())
+                        if is_compressible(ctype) and GZIP_MIN_SIZE <= st.st_size <= GZIP_MAX_SIZE:
+                            self.get(os.path.abspath(path), f, (st.st_mtime_ns, st.st_size))
+                except OSError:
+                    continue
+
+
+GZIP_CACHE = GzipCache(GZIP_CACHE_SIZE)
+
+
+class AssetVersions:
+    """Content hashes of static assets, for the versioned URLs pages link to.
+
+    A page's ``/css/``, ``/js/`` and ``/image/`` links get ``?v=<hash>``, so
+    those URLs can be cached for STATIC_MAX_AGE and still change as soon as
+    the asset does. Hashes are kept until the asset's mtime or size changes.
+    """
+
+    LINK = re.compile(rb'((?:href|src)=")(/(?:css|js|image)/[^"?#]+)"')
+
+    def __init__(self):
+        self.entries = {}   # path -> ((mtime_ns, size), hash)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return (hash, mtime) of the file at ``path``."""
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None or entry[0] != stamp:
+            with open(path, 'rb') as f:
+                entry = (stamp, hashlib.sha256(f.read()).hexdigest()[:16])
+            with self.lock:
+                self.entries[path] = entry
+        return entry[1], st.st_mtime
+
+    def render(self, path):
+        """Return the page at ``path`` with versioned asset links, and its newest mtime."""
+        with open(path, 'rb') as f:
+            page = f.read()
+        mtimes = [os.stat(path).st_mtime]
+
+        def versioned(m):
+            try:
+                digest, mtime = self.get(os.path.join(PUBLIC_DIR, m.group(2).decode()[1:]))
+            except (OSError, UnicodeDecodeError):
+                return m.group(0)
+            mtimes.append(mtime)
+            return b'%s%s?v=%s"' % (m.group(1), m.group(2), digest.encode())
+
+        return self.LINK.sub(versioned, page), max(mtimes)
+
+
+ASSET_VERSIONS = AssetVersions()
+
+
+class ArchiveWriter:
+    """Write-only file object for zipfile that counts what it passes on.
+
+    With ``chunked`` the output is framed with HTTP/1.1 chunked encoding,
+    gathering zipfile's many small writes into chunks of about CHUNK_SIZE.
+    """
+
+    def __init__(self, wfile, chunked=False):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.written += len(data)
+        if not self.chunked:
+            self.wfile.write(data)
+            return len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.chunked and self.buffered:
+            self.wfile.write(b'%x\r\n%s\r\n' % (self.buffered, b''.join(self.buffer)))
+            self.buffer = []
+            self.buffered = 0
+        self.wfile.flush()
+
+    def finish(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+class BodyReader:
+    """The request body: reads stop at Content-Length and what is left is known."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.rfile.close()
+
+
+class IdleConnections:
+    """Kept-alive connections waiting for their next request.
+
+    Rather than block a worker thread in readline() until the client sends
+    again, a handler releases its socket and the server parks it here once
+    the handler is done with it; one thread watches them all and hands a
+    connection back to ``dispatch`` as soon as it is readable, like a
+    freshly accepted one. Connections idle for KEEPALIVE_TIMEOUT are closed.
+    """
+
+    def __init__(self, dispatch, close):
+        self.dispatch = dispatch
+        self.close = close
+        self.lock = threading.Lock()
+        self.released = {}  # socket -> client address, until the server lets go of it
+        self.parked = {}    # socket -> (client address, deadline)
+        self.pending = []
+        self.thread = None
+        # Requests served so far on each connection, across parkings
+        self.served = weakref.WeakKeyDictionary()
+
+    def _start(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, name='keepalive', daemon=True)
+        self.thread.start()
+
+    def release(self, sock, client_address):
+        with self.lock:
+            self.released[sock] = client_address
+
+    def claim(self, sock):
+        """Park ``sock`` if its handler released it; called instead of closing it."""
+        with self.lock:
+            client_address = self.released.pop(sock, None)
+        if client_address is None:
+            return False
+        self.park(sock, client_address)
+        return True
+
+    def park(self, sock, client_address):
+        with self.lock:
+            if self.thread is None:
+                self._start()
+            self.parked[sock] = (client_address, time.monotonic() + KEEPALIVE_TIMEOUT)
+            self.pending.append(sock)
+        try:
+            self.wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select(1):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                sock = key.fileobj
+                self.selector.unregister(sock)
+                with self.lock:
+                    client_address, _ = self.parked.pop(sock)
+                try:
+                    # Most wake-ups are clients hanging up; don't queue those
+                    closed = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+                except BlockingIOError:
+                    closed = False
+                except OSError:
+                    closed = True
+                if closed:
+                    self.close(sock)
+                else:
+                    self.dispatch(sock, client_address)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for sock in pending:
+                self.selector.register(sock, selectors.EVENT_READ)
+            now = time.monotonic()
+            with self.lock:
+                expired = [sock for sock, (_, deadline) in self.parked.items() if deadline <= now]
+                for sock in expired:
+                    del self.parked[sock]
+            for sock in expired:
+                self.selector.unregister(sock)
+                self.close(sock)
+
+    def close_all(self):
+        with self.lock:
+            parked, self.parked = list(self.parked), {}
+        for sock in parked:
+            self.close(sock)
 
-if not os.path.exists(DATA_FILE):
-    with open(DATA_FILE, 'w') as f:
-        json.dump({}, f)
 
 class SimpleHandler(http.server.SimpleHTTPRequestHandler):
-    def is_authenticated(self):
-        if "Cookie" in self.headers:
-            c = http.cookies.SimpleCookie(self.headers["Cookie"])
-            if SESSION_COOKIE_NAME in c:
-                return c[SESSION_COOKIE_NAME].value in SESSIONS
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; don't let Nagle hold the body
+    # back for the client's delayed ACK on a kept-alive connection
+    disable_nagle_algorithm = True
+    timeout = CONNECTION_TIMEOUT
+
+    renewed_session = None
+    request_path = None
+    response_status = None
+    response_bytes = 0
+    request_body = None
+    connection_header_sent = False
+    admission_checked = False
+    upload_slot = False
+    head_wfile = None
+
+    def handle(self):
+        idle = getattr(self.server, 'idle', None)
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if idle is not None and not self.input_pending():
+                # Wait for the next request without holding this worker thread
+                idle.release(self.connection, self.client_address)
+                return
+            self.handle_one_request()
+
+    def input_pending(self):
+        """Whether the next request (or part of it) has already arrived."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        self.request_started = time.monotonic()
+        self.response_status = None
+        self.response_bytes = 0
+        self.connection_header_sent = False
+        self.admission_checked = False
+        ok = super().parse_request()
+        # do_GET rewrites self.path; log what the client asked for
+        self.request_path = self.path
+        if not ok:
+            return False
+        # Auth and routing only ever see the resolved path
+        path = normalize_request_path(self.path)
+        if path is None:
+            self.send_error(400, "Bad request path")
+            return False
+        self.path = path
+
+        idle = getattr(self.server, 'idle', None)
+        if idle is not None:
+            served = idle.served.get(self.connection, 0) + 1
+            idle.served[self.connection] = served
+            if served >= MAX_KEEPALIVE_REQUESTS:
+                self.close_connection = True
+
+        if self.headers.get('Transfer-Encoding'):
+            # Chunked request bodies aren't supported; don't try to find the next request
+            self.close_connection = True
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return False
+        self.request_body = BodyReader(self.rfile, max(0, length))
+        self.rfile = self.request_body
+        if not self.admission_checked and not self.admit():
+            return False
+        return True
+
+    def handle_expect_100(self):
+        # Decide before the client is told to send the body
+        if not self.admit():
+            return False
+        return super().handle_expect_100()
+
+    def admit(self):
+        """Apply admission control; send the rejection and return False if turned away."""
+        self.admission_checked = True
+        # Also runs from handle_expect_100(), before parse_request() has resolved the path
+        path = urllib.parse.urlsplit(normalize_request_path(self.path) or '/').path
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+
+        if length > body_limit(self.command, path):
+            return self.turn_away(413, "Request body too large", 'too_large')
+
+        limiter = RATE_LIMITERS.get(path) if self.command == 'POST' else None
+        if limiter is not None:
+            # Logins count per address; uploads per session, but only a session
+            # that validates, so a made-up cookie cannot buy a fresh bucket
+            key = self.client_ip()
+            if path != '/api/login':
+                token = cookie_value(self.headers.get("Cookie", ""), SESSION_COOKIE_NAME)
+                if token and SESSIONS.validate(token)[0]:
+                    key = token
+            wait = limiter.acquire(key)
+            if wait:
+                return self.turn_away(429, "Too many requests", 'rate_limited', wait)
+
+        is_upload = ((self.command == 'POST' and path == '/api/upload')
+                     or (self.command == 'PUT' and path.startswith('/api/uploads/')))
+        if is_upload:
+            if not UPLOAD_SLOTS.acquire(blocking=False):
+                return self.turn_away(503, "Too many uploads in progress", 'busy', UPLOAD_RETRY_AFTER)
+            self.upload_slot = True
+        return True
+
+    def has_metrics_token(self):
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        # As bytes: compare_digest raises on non-ASCII str
+        return (bool(METRICS_TOKEN) and scheme.lower() == 'bearer'
+                and hmac.compare_digest(token.strip().encode(), METRICS_TOKEN.encode()))
+
+    def client_ip(self):
+        """The peer's address, or for a trusted proxy the nearest X-Forwarded-For hop before it."""
+        ip = self.client_address[0]
+        hops = [hop.strip() for value in self.headers.get_all('X-Forwarded-For', [])
+                for hop in value.split(',')]
+        # Proxies append, so only the hops added by trusted ones can be believed
+        while ip in TRUSTED_PROXIES and hops:
+            ip = hops.pop()
+        return ip
+
+    def turn_away(self, status, message, reason, retry_after=None):
+        REJECTED.inc(route=route_label(self.path), reason=reason)
+        if self.request_body is None:
+            # Turned away at Expect: 100-continue; the body may still follow
+            self.close_connection = True
+        logging.warning(f"{self.address_string()} - {status} {message}: {self.command} {self.path}")
+        body = json.dumps({"success": False, "message": message}).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(max(1, int(retry_after + 0.999))))
+        self.end_headers()
+        self.wfile.write(body)
         return False
 
+    def handle_one_request(self):
+        self.request_body = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.head_wfile is not None:
+                self.wfile, self.head_wfile = self.head_wfile, None
+            if self.upload_slot:
+                UPLOAD_SLOTS.release()
+                self.upload_slot = False
+            # Also when the handler raised, so finish() closes the real file
+            if self.request_body is not None:
+                self.rfile = self.request_body.rfile
+        body = self.request_body
+        if body is not None and body.remaining and not self.close_connection:
+            self.discard_body(body)
+        if self.response_status is not None:
+            log_access(self, time.monotonic() - self.request_started)
+            self.response_status = None
+
+    def discard_body(self, body):
+        """Skip what the handler didn't read so the next request parses cleanly."""
+        if body.remaining <= MAX_DRAIN_BYTES:
+            try:
+                while body.read(CHUNK_SIZE):
+                    pass
+                if not body.remaining:
+                    return
+            except OSError:
+                pass
+        # Too much to read through: stop writing, then read briefly before
+        # closing so the client gets the response rather than a reset
+        self.close_connection = True
+        try:
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(LINGER_TIMEOUT)
+            deadline = time.monotonic() + LINGER_TIMEOUT
+            while time.monotonic() < deadline and self.connection.recv(CHUNK_SIZE * 4):
+                pass
+        except OSError:
+            pass
+
+    def log_request(self, code='-', size='-'):
+        # Called from send_response(); the access log line is written once the response is done
+        self.response_status = int(getattr(code, 'value', code))
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.response_bytes = int(value)
+        elif keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def is_authenticated(self):
+        token = cookie_value(self.headers.get("Cookie", ""), SESSION_COOKIE_NAME)
+        if token is None:
+            return False
+        valid, self.renewed_session = SESSIONS.validate(token)
+        return valid
+
+    def end_headers(self):
+        if self.renewed_session:
+            self.send_header('Set-Cookie', session_cookie(self.renewed_session, SESSIONS.cookie_max_age))
+            self.renewed_session = None
+        # response_status is None for an interim 100 Continue
+        if (self.close_connection and self.response_status is not None
+                and not self.connection_header_sent and self.request_version == 'HTTP/1.1'):
+            self.send_header('Connection', 'close')
+        super().end_headers()
+        if self.command == 'HEAD' and self.response_status is not None and self.head_wfile is None:
+            self.head_wfile, self.wfile = self.wfile, DiscardWriter()
+
+    @instrumented
     def do_GET(self):
+        self.handle_get()
+
+    @instrumented
+    def do_HEAD(self):
+        # Same checks and headers as GET; end_headers() swallows the body
+        self.handle_get()
+
+    def handle_get(self):
         # Public paths
         public_paths = ['/public/login.html', '/api/login']
         is_public_resource = self.path.startswith('/public/css/') or self.path.startswith('/public/js/') or self.path.startswith('/css/') or self.path.startswith('/js/')
-        
+        if self.path == '/api/metrics' and self.has_metrics_token():
+            public_paths.append(self.path)
+
         # Check auth
         if not self.is_authenticated():
             # Allow public assets and login page
@@ -52,52 +3045,82 @@ class SimpleHandler(http.server.SimpleHTTPRequestHandler):
                  # Redirect to login
                  self.send_response(302)
                  self.send_header('Location', '/public/login.html')
+                 self.send_header('Content-Length', '0')
                  self.end_headers()
                  return
         
+        if self.path == '/api/metrics':
+            body = render_metrics()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/api/uploads/'):
+            self.handle_upload_session('status', url.path[len('/api/uploads/'):])
+            return
+
         # Serve API: List Files
-        if self.path == '/api/files':
+        if url.path == '/api/files':
+            listing = FILE_INDEX.get()
+
+            if url.query:
+                try:
+                    params = urllib.parse.parse_qs(url.query)
+                    sort = params.get('sort', ['date'])[0]
+                    offset = max(0, int(params.get('offset', ['0'])[0]))
+                    limit = min(MAX_PAGE_SIZE, max(0, int(params.get('limit', [str(PAGE_SIZE)])[0])))
+                    if sort not in Listing.SORTS:
+                        raise ValueError(sort)
+                except ValueError:
+                    self.send_error(400, "Bad query")
+                    return
+                query = params.get('q', [''])[0]
+                digests = None
+                terms = normalize_text(query).split()
+                if terms and params.get('fulltext', ['0'])[0] == '1':
+                    with PHASE_SECONDS.time(phase='fulltext_search'):
+                        digests = METADATA.search_text(terms)
+                total, page = listing.search(query, params.get('tag', []), sort, offset, limit, digests)
+                body = json.dumps({"total": total, "offset": offset, "limit": limit,
+                                   "version": listing.version, "files": page}).encode()
+                etag = '"%s-%s"' % (listing.etag.strip('"'), hashlib.sha1(url.query.encode()).hexdigest()[:8])
+                self.send_json(body, etag, version=listing.version)
+            else:
+                self.send_json(listing.body, listing.etag, listing.gzip_body, listing.version)
+            return
+
+        if url.path == '/api/files/changes':
+            try:
+                since = parse_catalog_version(urllib.parse.parse_qs(url.query)['since'][0])
+            except (KeyError, ValueError):
+                self.send_error(400, "since must be a catalog version")
+                return
+            version, changes = catalog_changes(since)
+            body = json.dumps({"version": version, "reset": changes is None,
+                               "changes": changes or []}).encode()
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
             self.end_headers()
-            
-            files = []
-            if os.path.exists(DATA_FILE):
-                with open(DATA_FILE, 'r') as f:
-                    try:
-                        file_data = json.load(f)
-                    except json.JSONDecodeError:
-                        file_data = {}
-            else:
-                 file_data = {}
-                
-            real_files = set(os.listdir(UPLOAD_DIR))
-            
-            for fname in list(file_data.keys()):
-                if fname not in real_files:
-                    del file_data[fname]
-            
-            with open(DATA_FILE, 'w') as f:
-                json.dump(file_data, f)
-            
-            for fname in real_files:
-                if fname.startswith('.') or fname.endswith('.py') or fname.endswith('.log') or fname == 'data.json': continue
-                fpath = os.path.join(UPLOAD_DIR, fname)
-                try:
-                    stat = os.stat(fpath)
-                    meta = file_data.get(fname, {"tags": []})
-                    
-                    files.append({
-                        "name": fname,
-                        "size": stat.st_size,
-                        "date": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
-                        "tags": meta.get("tags", [])
-                    })
-                except OSError:
-                    continue
-            
-            files.sort(key=lambda x: x['date'], reverse=True)
-            self.wfile.write(json.dumps(files).encode())
+            self.wfile.write(body)
+            return
+
+        if url.path == '/api/events':
+            self.start_event_stream(url)
+            return
+
+        if url.path == '/api/archive':
+            params = urllib.parse.parse_qs(url.query)
+            tags = params.get('tag', [])
+            listing = FILE_INDEX.get()
+            _, entries = listing.search(params.get('q', [''])[0], tags, 'name', 0, len(listing.files))
+            self.send_archive([listing.files[listing.by_name[e["name"]]] for e in entries],
+                              '-'.join(['kakomon'] + tags) + '.zip')
             return
 
         # Serve Static Files
@@ -111,110 +3134,933 @@ class SimpleHandler(http.server.SimpleHTTPRequestHandler):
         elif not self.path.startswith('/api'):
              self.path = '/public' + self.path
 
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        path = self.translate_path(self.path)
+        ctype = None
+        blob = None
+        version = None
+        if self.path.startswith('/public/uploads/'):
+            name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path[len('/public/uploads/'):])
+            version = METADATA.blob_info(name)
+            if version:
+                digest = version[0]
+                # Names the blob for the gzip cache; the contents come from BLOBS
+                path = os.path.join(BLOB_DIR, digest)
+                ctype = self.guess_type(name)
+                try:
+                    blob = BLOBS.open(digest)
+                except FileNotFoundError:
+                    self.send_error(404, "File not found")
+                    return
+                except OSError:
+                    logging.exception(f"Could not read blob {digest}")
+                    self.send_error(503, "Storage unavailable")
+                    return
+        elif urllib.parse.urlsplit(self.path).path in PAGES:
+            try:
+                page, mtime = ASSET_VERSIONS.render(path)
+                st = os.stat(path)
+            except OSError:
+                self.send_error(404, "File not found")
+                return
+            # Validators follow the rendered page, which changes with any asset it links
+            blob = MemoryBlob(page, os.stat_result(st[:6] + (len(page),) + st[7:]))
+            version = (hashlib.sha256(page).hexdigest(), mtime)
+        if os.path.isdir(path):
+            return http.server.SimpleHTTPRequestHandler.do_GET(self)
+
+        if self.path.startswith(STATIC_PREFIXES):
+            # Only a versioned URL may be cached: an unversioned one could go stale
+            versioned = 'v' in urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            cache_control = f'public, max-age={STATIC_MAX_AGE}, immutable' if versioned else 'no-cache'
+        elif self.path.startswith('/public/uploads/'):
+            cache_control = 'private, no-cache'
+        else:
+            cache_control = 'no-cache'
+        return self.send_file(path, cache_control, ctype, blob, version)
+
+    def accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() in ('gzip', '*'):
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
+
+    def send_json(self, body, etag, gzip_body=None, version=None):
+        """Send a JSON body, gzipped when the client allows it and it is worth it."""
+        use_gzip = len(body) >= GZIP_MIN_SIZE and self.accepts_gzip()
+        if use_gzip:
+            # Each encoding is a different representation and needs its own strong ETag
+            etag = etag[:-1] + '-gz"'
+
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            if version is not None:
+                self.send_header('X-Catalog-Version', str(version))
+            self.end_headers()
+            return
+
+        if use_gzip:
+            body = gzip_body() if gzip_body else gzip.compress(body, compresslevel=6, mtime=0)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if version is not None:
+            # Where /api/files/changes and /api/events should continue from
+            self.send_header('X-Catalog-Version', str(version))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_range(self, size):
+        """Return a list of (start, end) byte ranges, [] if unsatisfiable, None to send it all."""
+        header = self.headers.get('Range', '')
+        unit, _, spec = header.partition('=')
+        if unit.strip().lower() != 'bytes' or not spec:
+            return None
+        ranges = []
+        for part in spec.split(','):
+            first, sep, last = part.strip().partition('-')
+            try:
+                if not sep:
+                    return None
+                if not first:
+                    # Suffix range: the last N bytes
+                    length = int(last)
+                    if length > 0 and size:
+                        ranges.append((max(0, size - length), size - 1))
+                    continue
+                start = int(first)
+                end = int(last) if last else None
+            except ValueError:
+                return None
+            if end is not None and end < start:
+                return None
+            # A range starting past the end is unsatisfiable (416), not invalid
+            if start < size:
+                ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+        if len(ranges) > MAX_RANGES:
+            return None
+        return ranges
+
+    def is_not_modified(self, etags, mtime):
+        if 'If-None-Match' in self.headers:
+            tags = [t.strip() for t in self.headers['If-None-Match'].split(',')]
+            return '*' in tags or any(etag in tags for etag in etags)
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def send_file(self, path, cache_control, ctype=None, f=None, version=None):
+        """Send the file at ``path``, or the already open blob ``f`` under that name.
+
+        ``version`` is (digest, added) for a blob: its local copy may be refetched
+        at any time, so the validators come from the metadata, not from fstat.
+        """
+        if f is None:
+            public = os.path.abspath(PUBLIC_DIR)
+            if os.path.commonpath([public, os.path.abspath(path)]) != public:
+                self.send_error(404, "File not found")
+                return
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                self.send_error(404, "File not found")
+                return
+
+        with f:
+            st = f.st if isinstance(f, MemoryBlob) else os.fstat(f.fileno())
+            size = st.st_size
+            if version:
+                etag = '"%s"' % version[0]
+                mtime = version[1]
+            else:
+                etag = '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, size)
+                mtime = st.st_mtime
+            gzip_etag = etag[:-1] + '-gz"'
+            ctype = ctype or self.guess_type(path)
+            compressible = is_compressible(ctype) and GZIP_MIN_SIZE <= size <= GZIP_MAX_SIZE
+
+            def common_headers(etag=etag):
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', self.date_time_string(int(mtime)))
+                self.send_header('Cache-Control', cache_control)
+                self.send_header('Accept-Ranges', 'bytes')
+                if compressible:
+                    self.send_header('Vary', 'Accept-Encoding')
+
+            if self.is_not_modified((etag, gzip_etag), mtime):
+                self.send_response(304)
+                common_headers()
+                self.end_headers()
+                return
+
+            ranges = None
+            if_range = self.headers.get('If-Range')
+            if if_range is None or if_range.strip() == etag:
+                ranges = self.parse_range(size)
+
+            # Ranges always refer to the identity encoding
+            gz = None
+            if ranges is None and compressible and self.accepts_gzip():
+                gz = GZIP_CACHE.get(path, f, etag)
+
+            if gz is not None:
+                self.send_response(200)
+                self.send_header('Content-type', ctype)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(gz)))
+                common_headers(gzip_etag)
+                self.end_headers()
+                self.wfile.write(gz)
+            elif ranges is None:
+                self.send_response(200)
+                self.send_header('Content-type', ctype)
+                self.send_header('Content-Length', str(size))
+                common_headers()
+                self.end_headers()
+                self.send_range(f, 0, size)
+            elif not ranges:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                common_headers()
+                self.end_headers()
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-type', ctype)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Content-Length', str(end - start + 1))
+                common_headers()
+                self.end_headers()
+                self.send_range(f, start, end - start + 1)
+            else:
+                boundary = uuid.uuid4().hex
+                heads = [(f'\r\n--{boundary}\r\nContent-Type: {ctype}\r\n'
+                          f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+                         for start, end in ranges]
+                tail = f'\r\n--{boundary}--\r\n'.encode()
+                length = sum(len(h) for h in heads) + sum(e - s + 1 for s, e in ranges) + len(tail)
+                self.send_response(206)
+                self.send_header('Content-type', f'multipart/byteranges; boundary={boundary}')
+                self.send_header('Content-Length', str(length))
+                common_headers()
+                self.end_headers()
+                for head, (start, end) in zip(heads, ranges):
+                    self.wfile.write(head)
+                    self.send_range(f, start, end - start + 1)
+                self.wfile.write(tail)
+
+    def start_event_stream(self, url):
+        # EventSource sends Last-Event-ID when it reconnects
+        since = self.headers.get('Last-Event-ID') or urllib.parse.parse_qs(url.query).get('since', [None])[0]
+        try:
+            since = parse_catalog_version(since) if since is not None else None
+        except ValueError:
+            # Start over with a reset rather than refuse a reconnecting client
+            since = None
+        if EVENT_HUB.full():
+            self.send_response(503)
+            self.send_header('Retry-After', '10')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # The stream ends when the connection does
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.wfile.write(b'retry: 3000\n\n')
+        self.wfile.flush()
+        EVENT_HUB.attach(self.connection, since)
+
+    def send_archive(self, files, archive_name):
+        """Stream a ZIP of ``files`` as it is built; nothing is staged on disk.
+
+        The response is written as it is produced, so entries carry data
+        descriptors instead of sizes in their local headers.
+        """
+        chunked = self.request_version == 'HTTP/1.1'
+        if not chunked:
+            self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', "attachment; filename*=UTF-8''%s"
+                         % urllib.parse.quote(archive_name))
+        self.send_header('Cache-Control', 'no-store')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        out = ArchiveWriter(self.wfile, chunked)
+        count = 0
+        try:
+            with zipfile.ZipFile(out, 'w', allowZip64=True) as zf:
+                for f in files:
+                    try:
+                        if f.get("digest"):
+                            src = BLOBS.open(f["digest"])
+                        else:
+                            src = open(os.path.join(UPLOAD_DIR, f["name"]), 'rb')
+                    except OSError:
+                        continue
+                    with src:
+                        info = zipfile.ZipInfo(f["name"], time.localtime(max(f["mtime"], 315532800))[:6])
+                        info.file_size = f["size"]
+                        info.external_attr = 0o644 << 16
+                        ctype = mimetypes.guess_type(f["name"])[0] or ''
+                        if ctype.startswith(ARCHIVE_STORED_TYPES):
+                            info.compress_type = zipfile.ZIP_STORED
+                        else:
+                            info.compress_type = zipfile.ZIP_DEFLATED
+                        with zf.open(info, 'w') as entry:
+                            shutil.copyfileobj(src, entry, CHUNK_SIZE * 4)
+                    count += 1
+            out.finish()
+        except (BrokenPipeError, ConnectionResetError):
+            logging.info(f"Client went away during {archive_name} after {count} files")
+            self.close_connection = True
+            return
+        self.response_bytes = out.written
+        logging.info(f"Sent {archive_name}: {count} files, {out.written} bytes")
+
+    def send_range(self, f, offset, count):
+        # socket.sendfile() uses os.sendfile() where available, so the
+        # data goes from the page cache to the socket without Python copies
+        if count and self.command != 'HEAD':
+            self.wfile.flush()
+            self.connection.sendfile(f, offset, count)
+
+    def reply_text(self, status, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def commit_upload(self, filename, tags, digest, size, tmp_path, started):
+        """Record a received file in the metadata store; return (name, duplicate)."""
+        with PHASE_SECONDS.time(phase='metadata_commit'):
+            filename, duplicate = METADATA.add_file(filename, tags, digest, size, tmp_path)
+        logging.info(f"File saved to {filename} ({size} bytes, sha256 {digest}"
+                     f"{', duplicate' if duplicate else ''})")
+        METADATA.enqueue_job(digest)
+        JOB_RUNNER.notify()
+        FILE_INDEX.invalidate()
+        EVENT_HUB.notify()
+        UPLOAD_BYTES.inc(size)
+        UPLOAD_SECONDS.observe(time.perf_counter() - started)
+        return filename, duplicate
+
+    def handle_upload_session(self, action, upload_id):
+        """Resumable upload API: /api/uploads[/<id>[/finalize]]."""
+        try:
+            if action == 'create':
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(min(length, MAX_FIELD_SIZE)) or b'{}')
+                filename = os.path.basename(str(data.get('filename') or ''))
+                size = int(data.get('size') or 0)
+                if not filename or size <= 0:
+                    raise UploadSessionError(400, "filename and size are required")
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadSessionError(413, "File too large")
+                upload_id = CHUNKED_UPLOADS.create(filename, size, list(data.get('tags') or []))
+                self.reply_json(201, {"id": upload_id, "chunk_size": UPLOAD_CHUNK_SIZE})
+            elif action == 'status':
+                self.reply_json(200, dict(CHUNKED_UPLOADS.info(upload_id), chunk_size=UPLOAD_CHUNK_SIZE))
+            elif action == 'chunk':
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                try:
+                    offset = int(query['offset'][0])
+                    length = int(self.headers['Content-Length'])
+                except (KeyError, ValueError, TypeError):
+                    raise UploadSessionError(400, "offset and Content-Length are required")
+                received = CHUNKED_UPLOADS.write(upload_id, offset, length, self.rfile)
+                self.reply_json(200, {"received": received})
+            elif action == 'finalize':
+                started = time.perf_counter()
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(min(length, MAX_FIELD_SIZE)) or b'{}')
+                info, digest, tmp_path = CHUNKED_UPLOADS.finalize(upload_id)
+                try:
+                    tags = list(data['tags']) if 'tags' in data else info["tags"]
+                    filename, duplicate = self.commit_upload(info["filename"], tags, digest,
+                                                             info["size"], tmp_path, started)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                self.reply_json(200, {"success": True, "file": filename,
+                                      "sha256": digest, "duplicate": duplicate})
+            elif action == 'abort':
+                CHUNKED_UPLOADS.abort(upload_id)
+                self.reply_json(200, {"success": True})
+        except UploadSessionError as e:
+            reply = {"success": False, "message": str(e)}
+            if e.received is not None:
+                reply["received"] = e.received
+            self.reply_json(e.status, reply)
+        except (ValueError, TypeError, AttributeError):
+            self.reply_json(400, {"success": False, "message": "Bad request"})
+
+    def upload_session_route(self):
+        """Split /api/uploads/<id>[/finalize] into (id, suffix), or None."""
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith('/api/uploads/'):
+            return None
+        upload_id, _, suffix = path[len('/api/uploads/'):].partition('/')
+        return upload_id, suffix
+
+    @instrumented
+    def do_PUT(self):
+        if not self.is_authenticated():
+            self.reply_text(401, 'Unauthorized')
+            return
+        route = self.upload_session_route()
+        if route is None or route[1]:
+            self.send_error(404)
+            return
+        self.handle_upload_session('chunk', route[0])
+
+    @instrumented
+    def do_DELETE(self):
+        if not self.is_authenticated():
+            self.reply_text(401, 'Unauthorized')
+            return
+        route = self.upload_session_route()
+        if route is None or route[1]:
+            self.send_error(404)
+            return
+        self.handle_upload_session('abort', route[0])
 
+    @instrumented
     def do_POST(self):
-        logging.info(f"POST request to {self.path}")
-        logging.debug(f"Headers: {self.headers}")
+        logging.debug("POST request to %s", self.path)
+        logging.debug("Headers: %s", self.headers)
 
         if self.path == '/api/login':
-            content_length = int(self.headers['Content-Length'])
-            body = self.rfile.read(content_length)
+            body = self.rfile.read(MAX_FIELD_SIZE)
             try:
                 data = json.loads(body)
                 if data.get('password') == PASSWORD:
-                    session_id = str(uuid.uuid4())
-                    SESSIONS.add(session_id)
-                    
+                    session_id = SESSIONS.create()
+
                     self.send_response(200)
-                    c = http.cookies.SimpleCookie()
-                    c[SESSION_COOKIE_NAME] = session_id
-                    c[SESSION_COOKIE_NAME]["path"] = "/"
-                    self.send_header('Set-Cookie', c.output(header='').strip())
+                    self.send_header('Set-Cookie', session_cookie(session_id, SESSIONS.cookie_max_age))
+                    self.send_header('Content-Length', '2')
                     self.end_headers()
                     self.wfile.write(b'OK')
                     return
             except Exception:
                 pass
             
-            self.send_response(401)
-            self.end_headers()
-            self.wfile.write(b'Unauthorized')
+            self.reply_text(401, 'Unauthorized')
             return
 
         if not self.is_authenticated():
-             self.send_response(401)
-             self.end_headers()
+             self.reply_text(401, 'Unauthorized')
              return
 
+        if self.path == '/api/uploads':
+            self.handle_upload_session('create', None)
+            return
+
+        route = self.upload_session_route()
+        if route is not None:
+            if route[1] == 'finalize':
+                self.handle_upload_session('finalize', route[0])
+            else:
+                self.send_error(404)
+            return
+
         if self.path == '/api/upload':
             try:
                 content_length = int(self.headers['Content-Length'])
                 logging.info(f"Receiving upload. Content-Length: {content_length}")
                 
-                body = self.rfile.read(content_length)
-                
-                headers = b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n'
-                msg = BytesParser(policy=default).parsebytes(headers + body)
-                
-                file_data = None
-                filename = None
+                boundary = self.headers.get_param('boundary')
+                if not boundary:
+                    raise ValueError("Upload is not multipart/form-data")
+
+                stream = MultipartStream(self.rfile, content_length, boundary.encode('latin-1'))
+                # Every "file" part is one upload; "tags" applies to all of them
+                # and "tags.<n>" to the n-th file only (counting from 0)
+                received = []
                 tags = []
-                
-                if msg.is_multipart():
-                    for part in msg.iter_parts():
+                file_tags = {}
+                started = time.perf_counter()
+                write_time = 0
+                results = []
+
+                try:
+                    for part, body in stream.parts():
                         name = part.get_param('name', header='content-disposition')
-                        
-                        if name == 'file':
-                            filename = part.get_filename()
-                            if filename:
-                                file_data = part.get_payload(decode=True)
-                        elif name == 'tags':
-                            tags_payload = part.get_payload(decode=True).decode('utf-8')
-                            tags = [t.strip() for t in tags_payload.split(',')] if tags_payload else []
-
-                if file_data and filename:
-                    filename = os.path.basename(filename)
-                    target_path = os.path.join(UPLOAD_DIR, filename)
-                    
-                    if os.path.exists(target_path):
-                        name, ext = os.path.splitext(filename)
-                        filename = f"{name}_{int(datetime.now().timestamp())}{ext}"
-                        target_path = os.path.join(UPLOAD_DIR, filename)
-
-                    with open(target_path, 'wb') as f:
-                        f.write(file_data)
-                    
-                    logging.info(f"File saved to {target_path}")
-
-                    current_data = {}
-                    if os.path.exists(DATA_FILE):
-                         with open(DATA_FILE, 'r') as f:
-                            try:
-                                current_data = json.load(f)
-                            except json.JSONDecodeError:
-                                pass
-                                
-                    current_data[filename] = {"tags": tags}
-                    
-                    with open(DATA_FILE, 'w') as f:
-                        json.dump(current_data, f)
 
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"success": True, "file": filename}).encode())
+                        if name == 'file' and part.get_filename():
+                            if len(received) >= MAX_BATCH_FILES:
+                                raise ValueError("Too many files in one upload")
+                            fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, prefix='.upload-')
+                            upload = {"name": os.path.basename(part.get_filename()), "tmp_path": tmp_path}
+                            received.append(upload)
+                            size = 0
+                            sha = hashlib.sha256()
+                            with os.fdopen(fd, 'wb') as f:
+                                for chunk in body:
+                                    sha.update(chunk)
+                                    t = time.perf_counter()
+                                    f.write(chunk)
+                                    write_time += time.perf_counter() - t
+                                    size += len(chunk)
+                            upload.update(size=size, digest=sha.hexdigest())
+                        elif name == 'tags' or (name or '').startswith('tags.'):
+                            tags_payload = stream.read_field(body).decode('utf-8')
+                            parsed = [t.strip() for t in tags_payload.split(',')] if tags_payload else []
+                            if name == 'tags':
+                                tags = parsed
+                            else:
+                                file_tags[int(name[len('tags.'):])] = parsed
+
+                    # Reading and boundary scanning is everything that wasn't the disk write
+                    PHASE_SECONDS.observe(time.perf_counter() - started - write_time, phase='parse')
+                    PHASE_SECONDS.observe(write_time, phase='disk_write')
+
+                    for i, upload in enumerate(received):
+                        if not upload["size"] or not upload["name"]:
+                            results.append({"name": upload["name"], "success": False, "message": "Empty file"})
+                            continue
+                        try:
+                            filename, duplicate = self.commit_upload(
+                                upload["name"], file_tags.get(i, tags), upload["digest"],
+                                upload["size"], upload["tmp_path"], started)
+                        except Exception:
+                            logging.exception(f"Could not store {upload['name']}")
+                            results.append({"name": upload["name"], "success": False,
+                                            "message": "Upload failed"})
+                            continue
+                        results.append({"name": upload["name"], "success": True, "file": filename,
+                                        "sha256": upload["digest"], "duplicate": duplicate})
+                finally:
+                    for upload in received:
+                        if os.path.exists(upload["tmp_path"]):
+                            os.remove(upload["tmp_path"])
+
+                if any(r["success"] for r in results):
+                    reply = {"success": all(r["success"] for r in results), "files": results}
+                    if len(results) == 1:
+                        # Single-file uploads keep their original response shape
+                        reply.update(results[0])
+                        del reply["name"]
+                    self.reply_json(200, reply)
+                    return
+                if results:
+                    self.reply_json(400, {"success": False, "message": "Upload failed", "files": results})
                     return
 
             except Exception as e:
                 logging.exception("Exception in do_POST")
                 pass
 
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": False, "message": "Upload failed"}).encode())
+            self.reply_json(400, {"success": False, "message": "Upload failed"})
+            return
+
+        self.send_error(404)
+
+
+def reject_connection(request):
+    # Queue is full: answer immediately instead of letting the client hang
+    try:
+        request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                        b"Retry-After: 1\r\nContent-Length: 0\r\n\r\n")
+    except OSError:
+        pass
+
+
+class ThreadPoolServer(socketserver.TCPServer):
+    """TCPServer that hands accepted connections to a fixed set of worker threads."""
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=THREAD_WORKERS, queue_size=QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.max_workers = workers
+        self.workers = []
+        self.idle = IdleConnections(self.process_request,
+                                    functools.partial(socketserver.TCPServer.shutdown_request, self))
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads are started here rather than in __init__ so that a
+        # pre-fork supervisor can bind first and fork afterwards
+        if not self.workers:
+            self.workers = [threading.Thread(target=self._worker, daemon=True)
+                            for _ in range(self.max_workers)]
+            for t in self.workers:
+                t.start()
+        # Pre-forked workers all wake up for one connection; the losers must
+        # not sit in accept() where they never see the shutdown flag
+        self.socket.setblocking(False)
+        super().serve_forever(poll_interval)
+
+    def get_request(self):
+        # BlockingIOError when another worker got there first, which
+        # _handle_request_noblock() ignores like any accept() error
+        request, client_address = self.socket.accept()
+        request.setblocking(True)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            logging.warning(f"Request queue full, rejecting {client_address}")
+            reject_connection(request)
+            self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        # Kept-alive and /api/events sockets outlive their handler
+        if not self.idle.claim(request) and not EVENT_HUB.owns(request):
+            super().shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.idle.close_all()
+        for _ in self.workers:
+            self.pending.put(None)
+        # Let queued and in-flight requests finish
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        for t in self.workers:
+            t.join(max(0, deadline - time.monotonic()))
+
+
+class AsyncioServer(socketserver.TCPServer):
+    """Accepts on an asyncio event loop and runs handlers in a bounded executor."""
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=THREAD_WORKERS, queue_size=QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.max_workers = workers
+        self.max_pending = workers + queue_size
+        self.active = 0
+        self.active_lock = threading.Lock()
+        self.loop = None
+        self.stopped = None
+        self.idle = IdleConnections(self.dispatch,
+                                    functools.partial(socketserver.TCPServer.shutdown_request, self))
+
+    def serve_forever(self, poll_interval=0.5):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.socket.setblocking(False)
+        accept = asyncio.ensure_future(self._accept_loop())
+        with ThreadPoolExecutor(self.max_workers) as self.executor:
+            await self.stopped.wait()
+            accept.cancel()
+            self.idle.close_all()
+
+    async def _accept_loop(self):
+        while True:
+            request, client_address = await self.loop.sock_accept(self.socket)
+            request.setblocking(True)
+            self._submit(request, client_address)
+
+    def dispatch(self, request, client_address):
+        # From the keep-alive thread: a parked connection has a new request
+        self.loop.call_soon_threadsafe(self._submit, request, client_address)
+
+    def _submit(self, request, client_address):
+        with self.active_lock:
+            full = self.active >= self.max_pending
+            if not full:
+                self.active += 1
+        if full:
+            logging.warning(f"Request queue full, rejecting {client_address}")
+            reject_connection(request)
+            socketserver.TCPServer.shutdown_request(self, request)
             return
+        self.loop.run_in_executor(self.executor, self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            # Before shutdown_request, which may park the connection and
+            # let it be dispatched again straight away
+            with self.active_lock:
+                self.active -= 1
+            self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        if not self.idle.claim(request) and not EVENT_HUB.owns(request):
+            super().shutdown_request(request)
+
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+ENGINES = {
+    'threadpool': ThreadPoolServer,
+    'asyncio': AsyncioServer,
+}
+
 
-with socketserver.TCPServer(("", PORT), SimpleHandler) as httpd:
-    print(f"Serving on port {PORT}")
+def make_server(engine, server_address, workers=THREAD_WORKERS, queue_size=QUEUE_SIZE):
+    return ENGINES[engine](server_address, SimpleHandler, workers=workers, queue_size=queue_size)
+
+
+def serve_worker(httpd, metadata_backend, job_workers, job_mode):
+    """Body of a pre-forked worker process."""
+    global METADATA, JOB_RUNNER
+    logging.getLogger().handlers = ACCESS_LOG.handlers = [logging.handlers.QueueHandler(LOG_QUEUE)]
+    # SQLite connections must not cross fork(); each worker opens its own
+    METADATA = open_metadata_store(metadata_backend, import_legacy=False)
+    JOB_RUNNER = JobRunner(job_workers, job_mode)
+    JOB_RUNNER.start()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown, daemon=True).start())
     httpd.serve_forever()
+    httpd.server_close()
+    JOB_RUNNER.stop()
+
+
+def run_supervisor(httpd, workers, metadata_backend, job_workers=JOB_WORKERS, job_mode=JOB_MODE):
+    """Fork ``workers`` processes sharing httpd's listening socket and keep them running."""
+    children = {}
+    stopping = False
+    kill_at = None
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve_worker(httpd, metadata_backend, job_workers, job_mode)
+            except BaseException:
+                logging.exception("Worker crashed")
+                code = 1
+            finally:
+                # Flush queued log records to the supervisor before exiting
+                LOG_QUEUE.close()
+                LOG_QUEUE.join_thread()
+                os._exit(code)
+        children[pid] = time.monotonic()
+        logging.info(f"Started worker {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping, kill_at
+        if stopping:
+            return
+        stopping = True
+        kill_at = time.monotonic() + WORKER_KILL_TIMEOUT
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        # Polled rather than os.wait(), which would sit out the kill deadline
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() >= kill_at:
+                for pid in children:
+                    logging.warning(f"Worker {pid} did not stop within {WORKER_KILL_TIMEOUT}s, killing it")
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                kill_at = float('inf')
+            time.sleep(0.1)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logging.error(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < 1:
+            # Don't spin if workers die straight away
+            time.sleep(1)
+        spawn()
+
+
+def main(argv=None):
+    global ACCESS_LOG_SAMPLE, METRICS_TOKEN
+    parser = argparse.ArgumentParser(description="Kakomon portal server")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_argument('--threads', type=int, default=THREAD_WORKERS,
+                        help="worker threads handling connections")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help="accepted connections waiting for a worker before new ones get 503")
+    parser.add_argument('--timeout', type=float, default=CONNECTION_TIMEOUT,
+                        help="per-connection socket timeout in seconds (0 disables)")
+    parser.add_argument('--metadata', choices=['sqlite', 'json'], default=METADATA_BACKEND,
+                        help="where file tags are stored")
+    parser.add_argument('--import-json', action='store_true',
+                        help=f"import {DATA_FILE} into {DB_FILE} and exit")
+    parser.add_argument('--storage', choices=['local', 's3'], default=STORAGE_BACKEND,
+                        help="where file contents are kept; s3 reads credentials from "
+                             "AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY")
+    parser.add_argument('--s3-endpoint', default=S3_ENDPOINT)
+    parser.add_argument('--s3-bucket', default=S3_BUCKET)
+    parser.add_argument('--s3-region', default=S3_REGION)
+    parser.add_argument('--s3-prefix', default=S3_PREFIX)
+    parser.add_argument('--cache-bytes', type=int, default=BLOB_CACHE_BYTES,
+                        help=f"local disk cache for remote storage, in {BLOB_CACHE_DIR}")
+    parser.add_argument('--memory-cache-bytes', type=int, default=MEMORY_CACHE_BYTES,
+                        help=f"in-memory cache for remote blobs up to {MEMORY_CACHE_MAX_OBJECT} bytes")
+    parser.add_argument('--migrate-uploads', action='store_true',
+                        help=f"move files from {UPLOAD_DIR} and unsharded blobs into the sharded "
+                             f"blob store and exit; safe while the server is running")
+    parser.add_argument('--sessions', choices=['memory', 'signed'], default=SESSION_BACKEND,
+                        help="in-process sessions, or HMAC-signed tokens shareable between workers")
+    parser.add_argument('--session-key', default=SESSION_SECRET_FILE,
+                        help="signing key file for signed sessions (also KAKOMON_SESSION_KEY); "
+                             f"created if missing, refused if under {PUBLIC_DIR}")
+    parser.add_argument('--session-ttl', type=int, default=SESSION_TTL,
+                        help="idle seconds before a session expires")
+    parser.add_argument('--workers', type=int, default=WORKER_PROCESSES,
+                        help="pre-forked worker processes sharing the listening socket")
+    parser.add_argument('--job-workers', type=int, default=JOB_WORKERS,
+                        help="background workers extracting text and metadata from uploads "
+                             "(per process; 0 disables)")
+    parser.add_argument('--job-mode', choices=['thread', 'process'], default=JOB_MODE,
+                        help="run extraction in threads or in a process pool")
+    parser.add_argument('--max-upload-bytes', type=int, default=MAX_UPLOAD_BYTES,
+                        help="largest upload accepted (the whole request for /api/upload)")
+    parser.add_argument('--max-inflight-uploads', type=int, default=MAX_INFLIGHT_UPLOADS,
+                        help="uploads received at once per process; more get 503")
+    parser.add_argument('--login-rate', type=float, default=LOGIN_RATE[0],
+                        help="login attempts per minute per client (0 disables)")
+    parser.add_argument('--upload-rate', type=float, default=UPLOAD_RATE[0],
+                        help="uploads started per minute per session (0 disables)")
+    parser.add_argument('--trusted-proxy', action='append', default=list(TRUSTED_PROXIES),
+                        help="address of a reverse proxy whose X-Forwarded-For names the client "
+                             "for rate limiting (repeatable)")
+    parser.add_argument('--metrics-token', default=METRICS_TOKEN,
+                        help="bearer token for scraping /api/metrics without a session "
+                             "(default $KAKOMON_METRICS_TOKEN, which keeps it out of ps)")
+    parser.add_argument('--log-file', default=LOG_FILE)
+    parser.add_argument('--access-log', default=ACCESS_LOG_FILE)
+    parser.add_argument('--log-level', default=LOG_LEVEL,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG also dumps request headers")
+    parser.add_argument('--log-max-bytes', type=int, default=LOG_MAX_BYTES,
+                        help="rotate log files at this size")
+    parser.add_argument('--log-backups', type=int, default=LOG_BACKUPS)
+    parser.add_argument('--access-sample', type=float, default=ACCESS_LOG_SAMPLE,
+                        help="fraction of successful requests to write to the access log")
+    args = parser.parse_args(argv)
+
+    ACCESS_LOG_SAMPLE = args.access_sample
+    METRICS_TOKEN = args.metrics_token
+    configure_admission(args.max_upload_bytes, args.max_inflight_uploads, args.login_rate, args.upload_rate,
+                        args.trusted_proxy)
+    listener = setup_logging(args.log_level, args.log_file, args.access_log,
+                             args.log_max_bytes, args.log_backups, processes=args.workers)
+    try:
+        serve(args)
+    finally:
+        listener.stop()
+
+
+def serve(args):
+    global METADATA, SESSIONS, JOB_RUNNER, BLOBS
+    if args.workers > 1 and args.sessions == 'memory':
+        # In-memory sessions would only be known to the worker that issued them
+        logging.warning("Multiple workers need shared sessions; using signed tokens")
+        args.sessions = 'signed'
+    try:
+        SESSIONS = open_session_store(args.sessions, args.session_ttl, args.session_key)
+    except ValueError as e:
+        raise SystemExit(f"Refusing to start: {e}")
+    BLOBS = open_blob_store(args.storage, args.s3_endpoint, args.s3_bucket, args.s3_region,
+                            args.s3_prefix, args.cache_bytes, args.memory_cache_bytes)
+    if args.import_json:
+        store = open_metadata_store('sqlite', import_legacy=False)
+        print(f"Imported {store.import_json(DATA_FILE)} entries from {DATA_FILE}")
+        return
+    METADATA = open_metadata_store(args.metadata)
+    if args.migrate_uploads:
+        moved, copied, adopted = migrate_uploads()
+        print(f"Moved {moved} blobs into shards, copied {copied} blobs to {args.storage} storage "
+              f"and adopted {adopted} files from {UPLOAD_DIR}")
+        return
+    if args.job_workers:
+        queued = enqueue_missing_jobs()
+        if queued:
+            logging.info(f"Queued {queued} files for background processing")
+    CHUNKED_UPLOADS.sweep(force=True)
+    sweep_upload_files()
+    GZIP_CACHE.warm(PUBLIC_DIR, skip=[UPLOAD_DIR])
+
+    SimpleHandler.timeout = args.timeout or None
+
+    with make_server(args.engine, ("", args.port), args.threads, args.queue_size) as httpd:
+        print(f"Serving on port {args.port} ({args.engine}, {args.threads} threads, "
+              f"{args.workers} worker{'s' if args.workers > 1 else ''})")
+        if args.workers > 1:
+            METADATA.close()
+            run_supervisor(httpd, args.workers, args.metadata, args.job_workers, args.job_mode)
+            return
+        JOB_RUNNER = JobRunner(args.job_workers, args.job_mode)
+        JOB_RUNNER.start()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            JOB_RUNNER.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""A small in-memory stand-in for an S3-compatible object store.
+
+Understands just what S3BlobStore sends: path-style HEAD, GET (with an
+optional single Range), PUT and DELETE. Requests must carry a SigV4
+Authorization header for ``access_key``, and every PUT body must match
+its x-amz-content-sha256 header, as MinIO and S3 check it. Counts of each
+method are kept in ``requests`` so tests can see what actually went over
+the wire.
+
+    python tests/fake_s3.py 9000    # serve on 127.0.0.1:9000 until killed
+"""
+import collections
+import hashlib
+import http.server
+import re
+import socketserver
+import sys
+import threading
+
+ACCESS_KEY = 'minio'
+SECRET_KEY = 'minio123'
+
+
+class FakeS3Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def authorized(self):
+        self.server.requests[self.command] += 1
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith(f'AWS4-HMAC-SHA256 Credential={self.server.access_key}/'):
+            self.reply(403)
+            return False
+        return True
+
+    def do_HEAD(self):
+        if self.authorized():
+            data = self.server.objects.get(self.path)
+            self.reply(404) if data is None else self.reply(200, data)
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        data = self.server.objects.get(self.path)
+        if data is None:
+            return self.reply(404)
+        m = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m is None:
+            return self.reply(200, data)
+        start = int(m.group(1))
+        end = min(int(m.group(2)) if m.group(2) else len(data) - 1, len(data) - 1)
+        if start > end:
+            return self.reply(416, headers=[('Content-Range', f'bytes */{len(data)}')])
+        self.reply(206, data[start:end + 1], [('Content-Range', f'bytes {start}-{end}/{len(data)}')])
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.authorized():
+            return
+        if hashlib.sha256(data).hexdigest() != self.headers.get('x-amz-content-sha256'):
+            return self.reply(400)
+        self.server.objects[self.path] = data
+        self.reply(200)
+
+    def do_DELETE(self):
+        if self.authorized():
+            self.server.objects.pop(self.path, None)
+            self.reply(204)
+
+
+class FakeS3(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, access_key=ACCESS_KEY):
+        super().__init__(('127.0.0.1', port), FakeS3Handler)
+        self.access_key = access_key
+        self.objects = {}   # '/bucket/key' -> bytes
+        self.requests = collections.Counter()
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    FakeS3(int(sys.argv[1]) if len(sys.argv) > 1 else 9000).serve_forever()
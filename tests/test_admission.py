@@ -0,0 +1,125 @@
+"""Rate limiting and the 413/429/503 decisions of SimpleHandler.admit()."""
+import http.client
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = server.RateLimiter(60, 3, max_keys=2, clock=self.clock)
+
+    def test_burst_then_refill(self):
+        self.assertEqual([self.limiter.acquire('a') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.limiter.acquire('a'), 1.0)
+        self.clock.now += 0.5
+        self.assertAlmostEqual(self.limiter.acquire('a'), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(self.limiter.acquire('a'), 0)
+        # A long pause refills only up to the burst
+        self.clock.now += 3600
+        self.assertEqual([self.limiter.acquire('a') for _ in range(3)], [0, 0, 0])
+        self.assertGreater(self.limiter.acquire('a'), 0)
+
+    def test_keys_are_separate_and_bounded(self):
+        for _ in range(3):
+            self.limiter.acquire('a')
+        self.assertGreater(self.limiter.acquire('a'), 0)
+        self.assertEqual(self.limiter.acquire('b'), 0)
+        # 'a' is the least recently seen of three keys, so it starts over
+        self.assertEqual(self.limiter.acquire('c'), 0)
+        self.assertEqual(list(self.limiter.buckets), ['b', 'c'])
+        self.assertEqual(self.limiter.acquire('a'), 0)
+
+    def test_zero_rate(self):
+        limiter = server.RateLimiter(0, 1, clock=self.clock)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('a'), 60)
+
+
+class AdmitTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = server.SESSIONS
+        server.SESSIONS = server.SignedSessionStore(b'k' * 32, ttl=3600)
+        self.httpd = server.ThreadPoolServer(('127.0.0.1', 0), server.SimpleHandler, workers=2)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        server.SESSIONS = self.saved
+        server.configure_admission(server.MAX_UPLOAD_BYTES, server.MAX_INFLIGHT_UPLOADS,
+                                   server.LOGIN_RATE[0], server.UPLOAD_RATE[0])
+
+    def configure(self, max_upload_bytes=1 << 20, max_inflight_uploads=4, login_rate=60, upload_rate=60,
+                  trusted_proxies=()):
+        server.configure_admission(max_upload_bytes, max_inflight_uploads, login_rate, upload_rate,
+                                   trusted_proxies)
+
+    def request(self, method, path, body=b'', headers=None):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status, response.headers.get('Retry-After')
+
+    def login(self, headers=None):
+        return self.request('POST', '/api/login', json.dumps({"password": "wrong"}), headers)
+
+    def test_body_too_large(self):
+        self.configure(max_upload_bytes=1000)
+        self.assertEqual(self.request('POST', '/api/login', b'x' * (server.MAX_FIELD_SIZE + 1))[0], 413)
+        # Checked from Content-Length alone, before any of the body is read
+        status, _ = self.request('POST', '/api/upload', headers={'Content-Length': '1001'})
+        self.assertEqual(status, 413)
+
+    def test_login_rate_limited_per_client(self):
+        self.configure(login_rate=1)
+        statuses = [self.login()[0] for _ in range(server.LOGIN_RATE[1])]
+        self.assertNotIn(429, statuses)
+        status, retry_after = self.login()
+        self.assertEqual(status, 429)
+        self.assertGreaterEqual(int(retry_after), 1)
+
+    def test_forwarded_for_only_from_trusted_proxies(self):
+        self.configure(login_rate=1)
+        for _ in range(server.LOGIN_RATE[1]):
+            self.login({'X-Forwarded-For': '203.0.113.1'})
+        # Not trusted: the header is ignored and the peer's bucket is empty
+        self.assertEqual(self.login({'X-Forwarded-For': '203.0.113.2'})[0], 429)
+
+        self.configure(login_rate=1, trusted_proxies=['127.0.0.1'])
+        for _ in range(server.LOGIN_RATE[1]):
+            self.assertNotEqual(self.login({'X-Forwarded-For': '198.51.100.7, 203.0.113.1'})[0], 429)
+        self.assertEqual(self.login({'X-Forwarded-For': '203.0.113.1'})[0], 429)
+        # Another client behind the same proxy has a bucket of its own
+        self.assertNotEqual(self.login({'X-Forwarded-For': '203.0.113.2'})[0], 429)
+
+    def test_upload_slots(self):
+        self.configure(max_inflight_uploads=0)
+        cookie = {'Cookie': f'{server.SESSION_COOKIE_NAME}={server.SESSIONS.create()}'}
+        status, retry_after = self.request('POST', '/api/upload', b'', cookie)
+        self.assertEqual((status, retry_after), (503, str(server.UPLOAD_RETRY_AFTER)))
+        # Chunks of resumable uploads take a slot too; other requests don't
+        self.assertEqual(self.request('PUT', '/api/uploads/' + '0' * 32, b'', cookie)[0], 503)
+        self.assertNotEqual(self.login()[0], 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Full-text search over extracted text, on both metadata backends."""
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+TEXTS = {'a': '数学の問題 c++ "quoted"', 'b': '英語の問題', 'c': 'calculus'}
+
+
+class SearchTextTests:
+    def test_search_text(self):
+        for digest, text in TEXTS.items():
+            self.store.complete_job(0, digest, {}, text)
+        for terms, expected in (
+                (['数学'], {'a'}),
+                (['問'], {'a', 'b'}),
+                (['の問題', '数'], {'a'}),
+                # Adjacent in the index is not enough: the real text must have the term
+                (['学問'], set()),
+                (['c++'], {'a'}),
+                (['+'], {'a'}),
+                (['"quoted"'], {'a'}),
+                (['calc', 'ulus'], {'c'}),
+                (['英語', 'calculus'], set()),
+                (['xyz'], set())):
+            self.assertEqual(self.store.search_text(terms), expected, terms)
+
+
+class JsonSearchTextTest(SearchTextTests, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'data.json')
+        self.store = server.JsonMetadataStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_text_moves_out_of_main_document(self):
+        with open(self.path, 'w') as f:
+            json.dump({'x.pdf': {'digest': 'a', 'derived': {}, 'text': TEXTS['a']}}, f)
+        store = server.JsonMetadataStore(self.path)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'x.pdf': {'digest': 'a', 'derived': {}}})
+        self.assertEqual(store.search_text(['数学']), {'a'})
+
+
+class SqliteSearchTextTest(SearchTextTests, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'data.sqlite3')
+        self.store = server.SqliteMetadataStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_index_is_used_and_filled_once(self):
+        self.store.complete_job(0, 'a', {}, TEXTS['a'])
+        self.store.complete_job(0, 'a', {}, TEXTS['a'])
+        conn = self.store.conn()
+        self.assertEqual(conn.execute('SELECT count(*) FROM text_docs').fetchone()[0], 1)
+        # Without the index, only the derived row would be left to find it
+        conn.execute("UPDATE derived SET text = '数学' || text")
+        self.assertEqual(self.store.search_text(['数学数学']), set())
+
+    def test_existing_text_is_indexed(self):
+        path = os.path.join(self.tmp, 'old.sqlite3')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE derived (digest TEXT PRIMARY KEY, data TEXT NOT NULL, text TEXT) WITHOUT ROWID')
+        conn.executemany('INSERT INTO derived VALUES (?, ?, ?)',
+                         [('a', '{}', TEXTS['a']), ('b', '{}', None)])
+        conn.commit()
+        conn.close()
+        store = server.SqliteMetadataStore(path)
+        self.assertEqual(store.search_text(['数学']), {'a'})
+        self.assertEqual(store.conn().execute('SELECT count(*) FROM text_docs').fetchone()[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
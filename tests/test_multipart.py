@@ -0,0 +1,125 @@
+"""MultipartStream against bodies split at every possible point."""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+BOUNDARY = b'----form1234'
+
+
+class ShortReader(io.BytesIO):
+    """Returns at most ``step`` bytes per read, as a socket may."""
+
+    def __init__(self, data, step):
+        super().__init__(data)
+        self.step = step
+
+    def read(self, size=-1):
+        return super().read(min(size, self.step) if size >= 0 else self.step)
+
+
+def form(*parts, preamble=b'', epilogue=b''):
+    body = preamble
+    for headers, data in parts:
+        body += b'--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + data + b'\r\n'
+    return body + b'--' + BOUNDARY + b'--' + epilogue
+
+
+def field(name, data):
+    return b'Content-Disposition: form-data; name="%s"' % name, data
+
+
+def parse(body, step, length=None):
+    stream = server.MultipartStream(ShortReader(body, step), len(body) if length is None else length, BOUNDARY)
+    parts = [(headers.get_param('name', header='content-disposition'), b''.join(chunks))
+             for headers, chunks in stream.parts()]
+    return parts, stream.remaining
+
+
+class MultipartStreamTest(unittest.TestCase):
+    def assertParses(self, body, expected):
+        # Every split point puts a delimiter or CRLF across two reads somewhere
+        for step in list(range(1, len(BOUNDARY) + 8)) + [64, len(body)]:
+            self.assertEqual(parse(body, step), (expected, 0), step)
+
+    def test_fields_and_file(self):
+        data = bytes(range(256)) * 3
+        body = form(field(b'tags', b'["a"]'),
+                    (b'Content-Disposition: form-data; name="file"; filename="x.pdf"\r\n'
+                     b'Content-Type: application/pdf', data))
+        self.assertParses(body, [('tags', b'["a"]'), ('file', data)])
+
+    def test_data_resembling_delimiters(self):
+        # CRLFs and partial delimiters inside a part are data, wherever reads split them
+        tricky = (b'\r\n', b'\r\n--', b'\r\n--' + BOUNDARY[:-1], b'--' + BOUNDARY,
+                  b'x\r\n--' + BOUNDARY[:5] + b'\r\n\r\n', b'\r')
+        for data in tricky:
+            self.assertParses(form(field(b'a', data), field(b'b', data)), [('a', data), ('b', data)])
+
+    def test_empty_parts(self):
+        self.assertParses(form(field(b'a', b''), field(b'b', b'')), [('a', b''), ('b', b'')])
+        self.assertParses(form(), [])
+
+    def test_preamble_and_epilogue(self):
+        body = form(field(b'a', b'1'), preamble=b'This is a preamble\r\n--not it\r\n',
+                    epilogue=b'\r\nand an epilogue\r\n--' + BOUNDARY + b'\r\n')
+        self.assertParses(body, [('a', b'1')])
+
+    def test_padding_after_boundary(self):
+        body = (b'--' + BOUNDARY + b'  \t\r\nContent-Disposition: form-data; name="a"\r\n\r\n1\r\n'
+                b'--' + BOUNDARY + b'--\r\n')
+        self.assertParses(body, [('a', b'1')])
+
+    def test_unread_part_is_skipped(self):
+        body = form(field(b'a', b'x' * 1000), field(b'b', b'2'))
+        stream = server.MultipartStream(ShortReader(body, 7), len(body), BOUNDARY)
+        names = [headers.get_param('name', header='content-disposition') for headers, _ in stream.parts()]
+        self.assertEqual(names, ['a', 'b'])
+
+    def test_truncated(self):
+        body = form(field(b'a', b'1'))
+        for cut in (0, 5, len(body) // 2, len(body) - 3):
+            with self.assertRaises(ValueError, msg=cut):
+                parse(body[:cut], 3, length=cut)
+            # The client closing the connection early looks the same
+            with self.assertRaises(ValueError, msg=cut):
+                parse(body[:cut], 3, length=len(body))
+
+    def test_limits(self):
+        stream = server.MultipartStream(io.BytesIO(b''), 0, BOUNDARY)
+        with self.assertRaises(ValueError):
+            stream.read_field(iter([b'x' * 10] * 2), limit=15)
+        huge = b'--' + BOUNDARY + b'\r\nX-Padding: ' + b'x' * (server.MAX_FIELD_SIZE + 10)
+        with self.assertRaises(ValueError):
+            parse(huge, 4096, length=len(huge) + 100)
+
+
+class SweepUploadFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved = server.BLOB_DIR
+        server.BLOB_DIR = self.tmp
+
+    def tearDown(self):
+        server.BLOB_DIR = self.saved
+        shutil.rmtree(self.tmp)
+
+    def test_only_stale_temp_files(self):
+        old = time.time() - server.STALE_UPLOAD_AGE - 60
+        for name in ('.upload-old', '.upload-new', 'ab'):
+            open(os.path.join(self.tmp, name), 'w').close()
+        os.utime(os.path.join(self.tmp, '.upload-old'), (old, old))
+        os.utime(os.path.join(self.tmp, 'ab'), (old, old))
+        self.assertEqual(server.sweep_upload_files(), 1)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['.upload-new', 'ab'])
+
+
+if __name__ == '__main__':
+    unittest.main()
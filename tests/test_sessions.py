@@ -0,0 +1,138 @@
+"""Session stores, how the handler treats cookies they reject, and /api/metrics auth."""
+import http.client
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class SignedSessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = server.SignedSessionStore(b'k' * 32, ttl=3600)
+
+    def signed(self, payload):
+        return f"{payload}.{self.store._sign(payload)}"
+
+    def test_fresh_token_is_valid(self):
+        self.assertEqual(self.store.validate(self.store.create()), (True, None))
+
+    def test_tampered_tokens(self):
+        token = self.store.create()
+        expires, nonce, signature = token.split('.')
+        for bad in (f"{int(expires) + 3600}.{nonce}.{signature}",
+                    f"{expires}.{nonce}x.{signature}",
+                    f"{expires}.{nonce}.{signature[:-1]}",
+                    f"{expires}.{nonce}.",
+                    signature, '', '.', '..'):
+            self.assertEqual(self.store.validate(bad), (False, None), bad)
+        other = server.SignedSessionStore(b'o' * 32, ttl=3600)
+        self.assertEqual(other.validate(token), (False, None))
+
+    def test_expired_and_malformed_payloads(self):
+        self.assertEqual(self.store.validate(self.signed(f"{int(time.time()) - 1}.abc")), (False, None))
+        self.assertEqual(self.store.validate(self.signed("soon.abc")), (False, None))
+
+    def test_renewed_past_half_life(self):
+        valid, renewed = self.store.validate(self.signed(f"{int(time.time()) + 60}.abc"))
+        self.assertTrue(valid)
+        self.assertEqual(self.store.validate(renewed), (True, None))
+
+    def test_non_ascii_tokens(self):
+        for bad in ('1.2.éé', 'é', f"{int(time.time()) + 60}.abc.ÿ",
+                    # Non-ASCII digits that int() would otherwise accept
+                    self.signed('١٢.abc')):
+            self.assertEqual(self.store.validate(bad), (False, None), bad)
+
+
+class MemorySessionStoreTest(unittest.TestCase):
+    def test_unknown_and_expired(self):
+        store = server.MemorySessionStore(ttl=0.05)
+        token = store.create()
+        self.assertEqual(store.validate(token), (True, None))
+        self.assertEqual(store.validate('1.2.éé'), (False, None))
+        time.sleep(0.1)
+        self.assertEqual(store.validate(token), (False, None))
+
+
+class HandlerCookieTest(unittest.TestCase):
+    """A cookie the store rejects is unauthenticated, never a dropped connection."""
+
+    def setUp(self):
+        self.saved = server.SESSIONS
+        server.SESSIONS = server.SignedSessionStore(b'k' * 32, ttl=3600)
+        self.httpd = server.ThreadPoolServer(('127.0.0.1', 0), server.SimpleHandler, workers=2)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        server.SESSIONS = self.saved
+
+    def request(self, method, path, cookie):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.putrequest(method, path)
+        # Sent as raw bytes, as a browser or attacker could
+        conn.putheader('Cookie', f'{server.SESSION_COOKIE_NAME}={cookie}'.encode('utf-8'))
+        conn.putheader('Content-Length', '0')
+        conn.endheaders()
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+
+    def test_bad_cookies_are_unauthenticated(self):
+        expired = f"{int(time.time()) - 1}.abc"
+        for cookie in ('1.2.éé', 'garbage', f"{expired}.{server.SESSIONS._sign(expired)}"):
+            self.assertEqual(self.request('GET', '/api/files', cookie), 302, cookie)
+            # Also goes through the upload rate limiter in admit()
+            self.assertEqual(self.request('POST', '/api/upload', cookie), 401, cookie)
+        # A good session gets past auth to complain about the empty upload
+        self.assertEqual(self.request('POST', '/api/upload', server.SESSIONS.create()), 400)
+
+
+class MetricsAuthTest(unittest.TestCase):
+    """/api/metrics takes a session or the metrics token, even from loopback."""
+
+    def setUp(self):
+        self.saved = server.SESSIONS, server.METRICS_TOKEN
+        server.SESSIONS = server.SignedSessionStore(b'k' * 32, ttl=3600)
+        self.httpd = server.ThreadPoolServer(('127.0.0.1', 0), server.SimpleHandler, workers=2)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        server.SESSIONS, server.METRICS_TOKEN = self.saved
+
+    def scrape(self, authorization=None, cookie=None):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.putrequest('GET', '/api/metrics')
+        if authorization is not None:
+            conn.putheader('Authorization', authorization.encode('utf-8'))
+        if cookie is not None:
+            conn.putheader('Cookie', f'{server.SESSION_COOKIE_NAME}={cookie}')
+        conn.endheaders()
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+
+    def test_metrics(self):
+        server.METRICS_TOKEN = ''
+        self.assertEqual(self.scrape(), 302)
+        self.assertEqual(self.scrape('Bearer '), 302)
+        self.assertEqual(self.scrape(cookie=server.SESSIONS.create()), 200)
+        server.METRICS_TOKEN = 's3cret'
+        self.assertEqual(self.scrape('Bearer s3cret'), 200)
+        self.assertEqual(self.scrape('bearer  s3cret'), 200)
+        for bad in ('Bearer wrong', 'Basic s3cret', 's3cret', 'Bearer s3crété', 'Bearer '):
+            self.assertEqual(self.scrape(bad), 302, bad)
+
+
+if __name__ == '__main__':
+    unittest.main()
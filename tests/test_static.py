@@ -0,0 +1,60 @@
+"""Cache headers for pages and the assets they link to."""
+import hashlib
+import http.client
+import os
+import re
+import sys
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+
+
+class StaticCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)
+        self.httpd = server.ThreadPoolServer(('127.0.0.1', 0), server.SimpleHandler, workers=2)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        os.chdir(self.cwd)
+
+    def get(self, path, headers=None):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def test_pages_link_versioned_assets(self):
+        response, page = self.get('/public/login.html')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        with open(os.path.join(ROOT, 'public', 'css', 'style.css'), 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        self.assertIn(f'href="/css/style.css?v={digest}"'.encode(), page)
+        self.assertEqual(int(response.headers['Content-Length']), len(page))
+
+        response, _ = self.get('/public/login.html', {'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status, 304)
+
+    def test_only_versioned_assets_are_long_lived(self):
+        _, page = self.get('/public/login.html')
+        url = re.search(rb'href="(/css/style\.css\?v=\w+)"', page).group(1).decode()
+        response, _ = self.get(url)
+        self.assertEqual(response.status, 200)
+        self.assertIn(f'max-age={server.STATIC_MAX_AGE}', response.headers['Cache-Control'])
+        response, _ = self.get('/css/style.css')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+"""S3 blob storage and its local cache, against the fake in fake_s3.py.
+
+Run with ``python -m unittest discover tests`` (or pytest) from the repo root.
+"""
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import server  # noqa: E402
+from fake_s3 import ACCESS_KEY, SECRET_KEY, FakeS3  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class S3BlobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3().start()
+        self.tmp = tempfile.mkdtemp()
+        self.s3_store = server.S3BlobStore(self.s3.endpoint, 'bucket', ACCESS_KEY, SECRET_KEY, prefix='blobs/')
+
+    def tearDown(self):
+        self.s3.stop()
+        shutil.rmtree(self.tmp)
+
+    def cache(self, disk_limit=1 << 20, memory_limit=0):
+        return server.BlobCache(self.s3_store, os.path.join(self.tmp, 'cache'), disk_limit, memory_limit)
+
+    def put(self, store, data):
+        digest = hashlib.sha256(data).hexdigest()
+        fd, path = tempfile.mkstemp(dir=self.tmp)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        store.prepare(path, digest)
+        store.put(path, digest)
+        self.assertFalse(os.path.exists(path))
+        return digest
+
+    def read(self, store, digest):
+        with store.open(digest) as f:
+            return f.read()
+
+    def test_put_and_get(self):
+        store = self.cache()
+        digest = self.put(store, b'hello s3')
+        self.assertEqual(self.s3.objects[f'/bucket/blobs/{digest}'], b'hello s3')
+        self.assertTrue(store.exists(digest))
+        # Served from the copy kept at upload time
+        self.assertEqual(self.read(store, digest), b'hello s3')
+        self.assertEqual(self.s3.requests['GET'], 0)
+        # And from the bucket once that copy is gone
+        self.assertEqual(self.read(server.BlobCache(self.s3_store, os.path.join(self.tmp, 'other'), 1 << 20, 0),
+                                   digest), b'hello s3')
+        self.assertEqual(self.s3.requests['GET'], 1)
+
+    def test_duplicate_put_is_only_a_head(self):
+        store = self.cache()
+        self.put(store, b'same bytes')
+        self.assertEqual(self.s3.requests['PUT'], 1)
+        heads = self.s3.requests['HEAD']
+        self.put(store, b'same bytes')
+        self.assertEqual(self.s3.requests['PUT'], 1)
+        self.assertGreater(self.s3.requests['HEAD'], heads)
+
+    def test_missing_and_deleted(self):
+        store = self.cache()
+        with self.assertRaises(FileNotFoundError):
+            store.open('0' * 64)
+        digest = self.put(store, b'short lived')
+        store.delete(digest)
+        self.assertEqual(self.s3.objects, {})
+        self.assertFalse(store.exists(digest))
+        with self.assertRaises(FileNotFoundError):
+            store.open(digest)
+
+    def test_eviction_refetches(self):
+        store = self.cache(disk_limit=1500)
+        first = self.put(store, b'a' * 1000)
+        second = self.put(store, b'b' * 1000)
+        # Only one fits: the older one was evicted and comes back from S3
+        self.assertEqual(sorted(os.listdir(store.root)), [second])
+        self.assertEqual(self.read(store, first), b'a' * 1000)
+        self.assertEqual(self.s3.requests['GET'], 1)
+        self.assertEqual(sorted(os.listdir(store.root)), [first])
+        self.assertEqual(self.read(store, second), b'b' * 1000)
+        self.assertEqual(self.s3.requests['GET'], 2)
+
+    def test_memory_cache(self):
+        store = self.cache(memory_limit=1 << 20)
+        digest = self.put(store, b'small')
+        self.assertIsInstance(store.open(digest), server.MemoryBlob)
+        os.remove(os.path.join(store.root, digest))
+        self.assertEqual(self.read(store, digest), b'small')
+
+
+class S3ServerTest(unittest.TestCase):
+    """Uploads and ranged downloads through server.py running on the S3 backend."""
+
+    def setUp(self):
+        self.s3 = FakeS3().start()
+        self.workdir = tempfile.mkdtemp()
+        self.port = free_port()
+        env = dict(os.environ, AWS_ACCESS_KEY_ID=ACCESS_KEY, AWS_SECRET_ACCESS_KEY=SECRET_KEY)
+        # A cache too small for both test files, so every other read refetches
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(self.port),
+             '--storage', 's3', '--s3-endpoint', self.s3.endpoint, '--s3-bucket', 'bucket',
+             '--cache-bytes', '3000', '--memory-cache-bytes', '0', '--job-workers', '0',
+             '--log-file', os.path.join(self.workdir, 'server.log'),
+             '--access-log', os.path.join(self.workdir, 'access.log')],
+            cwd=self.workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while True:
+            self.assertIsNone(self.proc.poll(), "server exited")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                self.assertLess(time.monotonic(), deadline, "server did not start")
+                time.sleep(0.1)
+        status, headers, _ = self.request('POST', '/api/login', json.dumps({"password": server.PASSWORD}))
+        self.assertEqual(status, 200)
+        self.cookie = headers['Set-Cookie'].split(';')[0]
+
+    def tearDown(self):
+        self.proc.terminate()
+        self.proc.wait()
+        self.s3.stop()
+        shutil.rmtree(self.workdir)
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        headers = dict(headers or {})
+        if hasattr(self, 'cookie'):
+            headers['Cookie'] = self.cookie
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response.status, response.headers, data
+
+    def upload(self, name, data):
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="tags"\r\n\r\n[]\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+        status, _, response = self.request('POST', '/api/upload', body,
+                                           {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        self.assertEqual(status, 200, response)
+        return json.loads(response)['file']
+
+    def test_ranges_and_validators_survive_eviction(self):
+        first = bytes(range(256)) * 8
+        second = os.urandom(2048)
+        first_name = self.upload('first.bin', first)
+        self.upload('second.bin', second)
+        self.upload('again.bin', first)
+        self.assertEqual(self.s3.requests['PUT'], 2)
+
+        status, headers, data = self.request('GET', f'/public/uploads/{first_name}', headers={'Range': 'bytes=10-19'})
+        self.assertEqual((status, data), (206, first[10:20]))
+        self.assertEqual(headers['Content-Range'], f'bytes 10-19/{len(first)}')
+        self.assertEqual(headers['ETag'], '"%s"' % hashlib.sha256(first).hexdigest())
+        etag, modified = headers['ETag'], headers['Last-Modified']
+
+        status, _, data = self.request('GET', '/public/uploads/second.bin', headers={'Range': 'bytes=-5'})
+        self.assertEqual((status, data), (206, second[-5:]))
+        status, _, _ = self.request('GET', '/public/uploads/second.bin', headers={'Range': 'bytes=4096-'})
+        self.assertEqual(status, 416)
+
+        # first.bin was evicted by second.bin; the refetched copy must look the same
+        gets = self.s3.requests['GET']
+        status, headers, data = self.request('GET', f'/public/uploads/{first_name}')
+        self.assertEqual((status, data), (200, first))
+        self.assertGreater(self.s3.requests['GET'], gets)
+        self.assertEqual((headers['ETag'], headers['Last-Modified']), (etag, modified))
+        status, _, _ = self.request('GET', f'/public/uploads/{first_name}', headers={'If-None-Match': etag})
+        self.assertEqual(status, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Resumable chunked uploads, including chunks that race finalize and abort."""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class RacingReader(io.BytesIO):
+    """Runs ``during`` after the first read, as another request would."""
+
+    def __init__(self, data, during):
+        super().__init__(data)
+        self.during = during
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if self.during:
+            self.during, during = None, self.during
+            during()
+        return data
+
+
+class ChunkedUploadsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.uploads = server.ChunkedUploads(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def status(self, *args):
+        with self.assertRaises(server.UploadSessionError) as cm:
+            self.uploads.write(*args)
+        return cm.exception.status
+
+    def test_write_and_finalize(self):
+        upload_id = self.uploads.create('a.pdf', 10, [])
+        self.assertEqual(self.uploads.write(upload_id, 5, 5, io.BytesIO(b'world')), [[5, 10]])
+        with self.assertRaises(server.UploadSessionError) as cm:
+            self.uploads.finalize(upload_id)
+        self.assertEqual((cm.exception.status, cm.exception.received), (409, [[5, 10]]))
+        self.assertEqual(self.uploads.write(upload_id, 0, 5, io.BytesIO(b'hello')), [[0, 10]])
+        info, _, tmp_path = self.uploads.finalize(upload_id)
+        with open(tmp_path, 'rb') as f:
+            self.assertEqual(f.read(), b'helloworld')
+        self.assertEqual(self.status(upload_id, 0, 5, io.BytesIO(b'hello')), 404)
+
+    def test_aborted_during_chunk(self):
+        upload_id = self.uploads.create('a.pdf', 10, [])
+        reader = RacingReader(b'hello', lambda: self.uploads.abort(upload_id))
+        self.assertEqual(self.status(upload_id, 0, 5, reader), 404)
+
+    def test_aborted_during_short_chunk_keeps_its_error(self):
+        upload_id = self.uploads.create('a.pdf', 10, [])
+        reader = RacingReader(b'he', lambda: self.uploads.abort(upload_id))
+        self.assertEqual(self.status(upload_id, 0, 5, reader), 400)
+
+    def test_finalized_during_chunk(self):
+        upload_id = self.uploads.create('a.pdf', 10, [])
+        self.uploads.write(upload_id, 0, 10, io.BytesIO(b'helloworld'))
+        reader = RacingReader(b'hello', lambda: self.uploads.finalize(upload_id))
+        self.assertEqual(self.status(upload_id, 0, 5, reader), 404)
+
+
+if __name__ == '__main__':
+    unittest.main()